@@ -1,46 +1,293 @@
+"""
+BF インタプリタのベンチマーク
+
+変換済みのインタプリタ (example2-c, ..., example6-c など) を同梱の BF プログラム
+すべてで実行し、実行時間と最大メモリ使用量を計測する。
+
+- 各組み合わせでウォームアップ実行の後、指定回数だけ計測する
+- example6-c は JIT のほかに AOT バックエンド (--aot) でも計測する
+- 時間は time.perf_counter() (単調増加・高分解能) で測る
+- 中央値・最小値・平均・標準偏差と最大 RSS を求める (RSS は実行中に
+  /proc/<pid>/status から読むので Linux のみ。読めなければ "-")
+- 出力の SHA-256 を取り、実行ごと・インタプリタ間・ベースラインとの間で一致を確認する
+- 結果を JSON で保存し、保存済みのベースラインと比較する
+
+使い方:
+    python3 evaluate.py --output results.json
+    python3 evaluate.py --baseline results.json --output new.json
+    python3 evaluate.py --interp "example6-py=python2 example6.py" --programs bottles.b
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shlex
+import statistics
 import subprocess
+import sys
+import threading
 import time
-import numpy as np
-import matplotlib.pyplot as plt
 
-# 実行するコマンドのリスト
-commands = [
-    "./example2-c mandel.b",
-    "./example3-c mandel.b",
-    "./example4-c mandel.b",
-    "./example5-c mandel.b"
-]
+PROGRAMS = ["mandel.b", "hanoi.b", "bench.b", "bottles.b", "99bottles.b"]
+INTERPRETERS = ["example2", "example3", "example4", "example5", "example6",
+                "example6-2"]
 
-# コマンドの実行回数
-n = 5
 
-# 実行時間を記録するリスト
-execution_times = []
+class RunError(Exception):
+    pass
 
-for cmd in commands:
-    times = []
-    for _ in range(n):
-        start_time = time.time()
+
+def default_interpreters():
+    """
+    変換済みバイナリ (<name>-c) が存在するものをすべて対象にする。
+    example6-c は JIT と AOT (--aot) の両方のエンジンで計測する。
+    """
+    found = []
+    for name in INTERPRETERS:
+        binary = "./%s-c" % name
+        if os.path.exists(binary):
+            found.append((name, [binary]))
+            if name == "example6":
+                # 初回の C コンパイルはウォームアップ実行で済ませる
+                found.append(("example6-aot", [binary, "--aot"]))
+    return found
+
+
+def parse_interp(spec):
+    """'name=command args...' の形式を (name, argv) に分解する"""
+    if "=" not in spec:
+        raise argparse.ArgumentTypeError("expected NAME=COMMAND: %r" % spec)
+    name, command = spec.split("=", 1)
+    return name, shlex.split(command)
+
+
+def watch_peak_rss(pid, result, interval=0.005):
+    """
+    /proc/<pid>/status の VmHWM (ピーク RSS) をプロセスが終わるまで読み続け、
+    その最大値 [KiB] を result["rss"] に入れる。読めなければ None のまま。
+    exec すると VmHWM は 0 からやり直しになるので (--aot など)、各時点の最大を取る
+    """
+    path = "/proc/%d/status" % pid
+    while True:
         try:
-            subprocess.run(cmd, shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error while executing '{cmd}': {e}")
-        end_time = time.time()
-        times.append(end_time - start_time)
-    execution_times.append(times)
-
-# 平均と標準偏差を計算
-means = [np.mean(times) for times in execution_times]
-std_devs = [np.std(times) for times in execution_times]
-
-# グラフの描画
-plt.figure(figsize=(10, 6))
-plt.bar(range(len(commands)), means, yerr=std_devs, capsize=5, alpha=0.7, color='skyblue')
-plt.xticks(range(len(commands)), commands, rotation=45, ha="right")
-plt.xlabel("Commands")
-plt.ylabel("Execution Time (seconds)")
-plt.title("Average Execution Time with Error Bars (Standard Deviation)")
-plt.tight_layout()
-
-# グラフを画像として保存
-plt.savefig("execution_time_plot.png")
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        hwm = [line.split()[1] for line in lines if line.startswith("VmHWM:")]
+        if not hwm:
+            return  # ゾンビになった
+        result["rss"] = max(result["rss"] or 0, int(hwm[0]))
+        time.sleep(interval)
+
+
+def run_once(command, program, timeout):
+    """
+    1 回実行し、(経過秒数, 最大 RSS [KiB] または None, 標準出力) を返す。
+    os.wait4() の ru_maxrss は fork した親 (このスクリプト) の RSS を引き継ぐので
+    使わず、実行中に子プロセス自身の VmHWM を数ミリ秒ごとに読む。
+    終了直前の増加は取りこぼしうるので、値は下限になる
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(command + [program], stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    rss = {"rss": None}
+    watcher = threading.Thread(target=watch_peak_rss, args=(proc.pid, rss))
+    watcher.start()
+    try:
+        output = proc.stdout.read()
+        # 回収 (wait) 前に止めないと、PID が別のプロセスに再利用されうる
+        watcher.join()
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    elapsed = time.perf_counter() - start
+
+    if proc.returncode != 0:
+        raise RunError("%s %s exited with status %d"
+                       % (" ".join(command), program, proc.returncode))
+    return elapsed, rss["rss"], output
+
+
+def measure(command, program, warmup, repeat, timeout):
+    for _ in range(warmup):
+        run_once(command, program, timeout)
+
+    times = []
+    max_rss = None
+    checksums = set()
+    for _ in range(repeat):
+        elapsed, rss, output = run_once(command, program, timeout)
+        times.append(elapsed)
+        if rss is not None:
+            max_rss = max(max_rss or 0, rss)
+        checksums.add(hashlib.sha256(output).hexdigest())
+
+    return {
+        "times": times,
+        "median": statistics.median(times),
+        "min": min(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "max_rss_kb": max_rss,
+        "sha256": checksums.pop() if len(checksums) == 1 else None,
+    }
+
+
+def verify(results, baseline):
+    """出力のチェックサムを検証し、問題点のリストを返す"""
+    problems = []
+    expected = {}
+    for name, programs in results.items():
+        for program, r in programs.items():
+            if "error" in r:
+                problems.append("%s %s: %s" % (name, program, r["error"]))
+                continue
+            if r["sha256"] is None:
+                problems.append("%s %s: output differs between runs"
+                                % (name, program))
+                continue
+            if program in expected and expected[program][1] != r["sha256"]:
+                problems.append("%s %s: output differs from %s"
+                                % (name, program, expected[program][0]))
+            expected.setdefault(program, (name, r["sha256"]))
+
+    if baseline is not None:
+        for name, programs in results.items():
+            for program, r in programs.items():
+                old = baseline["results"].get(name, {}).get(program)
+                if (old and old.get("sha256") and r.get("sha256")
+                        and old["sha256"] != r["sha256"]):
+                    problems.append("%s %s: output differs from baseline"
+                                    % (name, program))
+    return problems
+
+
+def compare(results, baseline, threshold):
+    """ベースラインとの中央値の比を表示し、閾値を超えて遅くなった組を返す"""
+    regressions = []
+    print()
+    print("%-12s %-12s %10s %10s %8s" % ("interpreter", "program",
+                                          "baseline", "now", "ratio"))
+    for name, programs in sorted(results.items()):
+        for program, r in sorted(programs.items()):
+            old = baseline["results"].get(name, {}).get(program)
+            if not old or "median" not in old or "median" not in r:
+                continue
+            ratio = r["median"] / old["median"]
+            mark = ""
+            if ratio > 1 + threshold:
+                mark = "  REGRESSION"
+                regressions.append((name, program, ratio))
+            elif ratio < 1 - threshold:
+                mark = "  faster"
+            print("%-12s %-12s %9.3fs %9.3fs %7.2fx%s"
+                  % (name, program, old["median"], r["median"], ratio, mark))
+    return regressions
+
+
+def plot(results, path):
+    # matplotlib がない環境でも計測自体はできるよう、グラフ描画時にだけ読み込む
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    names = sorted(results)
+    programs = sorted({p for r in results.values() for p in r})
+    width = 0.8 / max(len(names), 1)
+
+    plt.figure(figsize=(10, 6))
+    for i, name in enumerate(names):
+        medians = [results[name].get(p, {}).get("median", 0) for p in programs]
+        stdevs = [results[name].get(p, {}).get("stdev", 0) for p in programs]
+        xs = [x + i * width for x in range(len(programs))]
+        plt.bar(xs, medians, width, yerr=stdevs, capsize=3, label=name)
+    plt.xticks([x + width * (len(names) - 1) / 2 for x in range(len(programs))],
+               programs)
+    plt.xlabel("Programs")
+    plt.ylabel("Execution Time (seconds, median)")
+    plt.title("Execution Time per Interpreter")
+    plt.legend()
+    plt.tight_layout()
+    plt.savefig(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--interp", action="append", type=parse_interp,
+                        metavar="NAME=COMMAND",
+                        help="interpreter to measure (repeatable); default: "
+                             "every ./exampleN-c that exists")
+    parser.add_argument("--programs", nargs="+", default=PROGRAMS)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="seconds before a single run is killed")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="slowdown ratio reported as a regression")
+    parser.add_argument("--plot", help="save a bar chart of the medians here")
+    args = parser.parse_args(argv)
+
+    interpreters = args.interp or default_interpreters()
+    if not interpreters:
+        parser.error("no translated interpreters found; use --interp")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name, command in interpreters:
+        results[name] = {}
+        for program in args.programs:
+            try:
+                r = measure(command, program, args.warmup, args.repeat,
+                            args.timeout)
+            except (RunError, OSError) as e:
+                results[name][program] = {"error": str(e)}
+                print("%-12s %-12s error: %s" % (name, program, e))
+                continue
+            results[name][program] = r
+            print("%-12s %-12s median %8.3fs  min %8.3fs  stdev %7.3fs  "
+                  "rss %7s KiB" % (name, program, r["median"], r["min"],
+                                   r["stdev"], r["max_rss_kb"] or "-"))
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "warmup": args.warmup,
+            "repeat": args.repeat,
+            "commands": {name: command for name, command in interpreters},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    problems = verify(results, baseline)
+    for problem in problems:
+        print("CHECKSUM: %s" % problem)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+
+    if args.plot:
+        plot(results, args.plot)
+
+    return 1 if problems or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
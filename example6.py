@@ -3,21 +3,85 @@ PyPy tutorial by Andrew Brown
 example6.py - BF interpreter in RPython with aggressive JIT optimizations
 
 Optimizations applied:
-1. @elidable decorator for pure functions (bracket_map lookups)
+1. Jump targets stored in the bracket instructions' operands, so taking a
+   branch needs no bracket_map lookup
 2. @unroll_safe for functions with bounded loops
 3. promote() hint to turn runtime values into compile-time constants
 4. Virtualizables for the Tape object to avoid heap allocation
 5. Fixed-size tape array to enable better array optimizations
 6. loop_invariant hint for values that don't change in loops
+7. Compilation to an instruction array, with runs of +/- and >/< folded
+   into a single ADD/MOVE instruction (run-length encoding)
+8. Idiom recognition: clear loops ([-]) and copy/multiply loops
+   ([>+<-], [>++>+++<<-]) run as single CLEAR / MUL_ADD instructions
+9. Offset addressing: straight-line code between brackets accesses cells
+   relative to the head and moves the head once, at the end
+10. Scan loops ([>], [<], [>>>>]) run as a single SCAN instruction whose
+    search loop is kept out of the trace with @dont_look_inside
+11. Byte-backed tape: wrapping 8-bit cells (or 16/32-bit with --cell-bits)
+    stored in a flat byte array of configurable size (--tape-size)
+12. Growable tape (--grow-tape): doubles in either direction on demand;
+    only MOVE and SCAN check for room, because a slack region as wide as
+    the program's largest offset is kept around the head
+13. Buffered output: '.' appends to a buffer that is written out in large
+    chunks, before every ',' and at exit (--unbuffered turns this off)
+14. Buffered input: ',' takes bytes from a chunk read ahead from stdin, and
+    end of input is handled as selected with --eof instead of crashing
+15. Dead code elimination: loops that start on a cell known to be 0 (at
+    the start of the program, or right after another loop) are removed,
+    and straight-line ADDs to one cell are merged or dropped when a CLEAR
+    overwrites them; --optimizer-stats shows what each pass removed
+
+The --profile option counts executed instructions and loop iterations and
+prints a report at exit. The profiler is a green variable that is None
+when profiling is off, so the JIT folds its checks away. The --jit-stats
+option uses the JIT's hooks to report compiled loops, bridges, aborts and
+time spent tracing. With --cache-dir=DIR the compiled program is stored
+on disk, keyed by a hash of the source, and loaded from there next time.
+Without any of these the source is parsed chunk by chunk as it is read
+and never held in memory as a whole.
+--batch=MANIFEST runs many (program, input, output) jobs in one process,
+compiling each program once so that its JIT traces are reused.
+
+The interpreter can also be used as a library, translated or under plain
+Python 2, with input and output kept in memory:
+
+    program = compile_program(source)
+    output = program.run(input, max_steps=10000000)
+
+With --snapshot=FILE, SIGUSR1 makes the run save its whole state (pc,
+tape, head, unread input and the compiled program) to FILE and stop;
+--snapshot-every=N also saves it periodically, and --resume=FILE
+continues from it, on this or another machine.
+
+With --aot the compiled program is translated to C instead, built with
+the system C compiler and run natively, which saves the JIT's warmup for
+programs that are run over and over.
+
+Untranslated, --engine=python turns the compiled program into Python
+source with native while loops and runs it with exec, which is much
+faster than interpreting it with mainloop() on top of CPython.
+
+--precompute runs the program at load time up to its first ',' and
+starts the real run from the tape and output it got there. That state is
+kept as a snapshot in the cache directory, so a program that reads no
+input at all is reduced to writing out its stored output the next time.
+
+--max-steps and --time-limit stop runaway programs. Both are checked only
+where a loop jumps back, and the clock only every TIME_CHECK_INTERVAL
+steps, so code without backward jumps does no extra work.
 
 """
 
 import os
+import signal
 import sys
+import time
 
 try:
     from rpython.rlib.jit import JitDriver, elidable, unroll_safe, promote, promote_string
-    from rpython.rlib.jit import hint, set_param, we_are_jitted
+    from rpython.rlib.jit import hint, set_param, we_are_jitted, dont_look_inside
+    from rpython.rlib.jit import set_user_param
 except ImportError:
     class JitDriver(object):
         def __init__(self,**kw): pass
@@ -30,181 +94,2567 @@ except ImportError:
     def hint(x, **kw): return x
     def set_param(driver, name, value): pass
     def we_are_jitted(): return False
+    def dont_look_inside(f): return f
+    # The names rpython.rlib.jit.set_user_param() knows, so that bad --jit
+    # parameters are rejected untranslated as well
+    JIT_PARAMETERS = ['threshold', 'function_threshold', 'trace_eagerness',
+                      'decay', 'trace_limit', 'inlining', 'loop_longevity',
+                      'retrace_limit', 'pureop_historylength',
+                      'max_retrace_guards', 'max_unroll_loops',
+                      'disable_unrolling', 'enable_opts',
+                      'max_unroll_recursion', 'vec', 'vec_all', 'vec_cost']
+    def set_user_param(driver, text):
+        if text == 'off' or text == 'default':
+            return
+        for item in text.split(','):
+            parts = item.strip(' ').split('=')
+            if len(parts) != 2 or parts[0] not in JIT_PARAMETERS:
+                raise ValueError(text)
+            if parts[0] != 'enable_opts':
+                int(parts[1])
+
+try:
+    from rpython.rlib.jit import JitHookInterface, Counters
+    from rpython.rlib import jit_hooks
+    from rpython.rlib.objectmodel import we_are_translated
+    from rpython.rlib.nonconst import NonConstant
+except ImportError:
+    class JitHookInterface(object): pass
+    jit_hooks = None
+    def we_are_translated(): return False
+    def NonConstant(x): return x
 
 try:
-    from rpython.rlib.rarithmetic import ovfcheck
+    from rpython.rlib.rarithmetic import ovfcheck, intmask
 except ImportError:
     def ovfcheck(x): return x
+    def intmask(x): return x
+
+try:
+    from rpython.rlib.rmd5 import RMD5 as md5
+except ImportError:
+    from hashlib import md5
+
+try:
+    from rpython.rlib import rsignal
+    def watch_signal(signum):
+        rsignal.pypysig_setflag(signum)
+        rsignal.c_siginterrupt(signum, 0)
+    def poll_signal():
+        return rsignal.pypysig_poll()
+except ImportError:
+    pending_signals = []
+    def watch_signal(signum):
+        signal.signal(signum, lambda n, frame: pending_signals.append(n))
+        signal.siginterrupt(signum, False)
+    def poll_signal():
+        if pending_signals:
+            return pending_signals.pop(0)
+        return -1
+
+# Opcodes of the compiled instruction stream. Each instruction is an opcode
+# plus an integer operand and the tape offset (relative to the head) of the
+# cell it works on, stored in parallel arrays of a Program. MUL_ADD also has
+# a target offset.
+ADD = 0              # add operand to the cell
+MOVE = 1             # move the tape head by operand cells
+OUTPUT = 2           # '.'
+INPUT = 3            # ','
+JUMP_IF_ZERO = 4     # '['
+JUMP_IF_NONZERO = 5  # ']'
+CLEAR = 6            # set the cell to 0
+MUL_ADD = 7          # add cell * operand to the cell at the target offset
+SCAN = 8             # move the head by operand cells until it is on a 0
+
+OPCODE_NAMES = ['ADD', 'MOVE', 'OUTPUT', 'INPUT', 'JUMP_IF_ZERO',
+                'JUMP_IF_NONZERO', 'CLEAR', 'MUL_ADD', 'SCAN']
+
+
+def get_location(pc, program, profiler):
+    op = program.ops[pc]
+    if op == MUL_ADD:
+        return "%d:MUL_ADD(%d)@%d->%d" % (pc, program.args[pc],
+                                          program.offsets[pc],
+                                          program.targets[pc])
+    return "%d:%s(%d)@%d" % (pc, OPCODE_NAMES[op], program.args[pc],
+                             program.offsets[pc])
+
 
 # Use virtualizables to tell the JIT that 'tape' can be virtualized
 # This avoids heap allocation for the tape in compiled traces
 try:
     from rpython.rlib.jit import JitDriver
     jitdriver = JitDriver(
-        greens=['pc', 'program', 'bracket_map'],
-        reds=['tape'],
+        greens=['pc', 'program', 'profiler'],
+        reds=['steps', 'next_check', 'limits', 'tape', 'output', 'input'],
         virtualizables=['tape'],
-        get_printable_location=lambda pc, program, bracket_map: "%s_%s_%s" % (
-            program[pc-1] if pc > 0 else ' ',
-            program[pc],
-            program[pc+1] if pc + 1 < len(program) else ' '
-        )
+        get_printable_location=get_location
     )
 except:
     jitdriver = JitDriver(
-        greens=['pc', 'program', 'bracket_map'],
-        reds=['tape'],
-        get_printable_location=lambda pc, program, bracket_map: "%s_%s_%s" % (
-            program[pc-1] if pc > 0 else ' ',
-            program[pc],
-            program[pc+1] if pc + 1 < len(program) else ' '
-        )
+        greens=['pc', 'program', 'profiler'],
+        reds=['steps', 'next_check', 'limits', 'tape', 'output', 'input'],
+        get_printable_location=get_location
     )
 
 
-@elidable
-def get_bracket_target(bracket_map, pc):
-    return bracket_map.get(pc, -1)
+@dont_look_inside
+def scan_tape(thetape, pos, stride, width):
+    """
+    Returns the first cell index pos + k * stride (k >= 0) holding a 0.
+    Cells outside the allocated tape count as 0, so the result may lie just
+    outside it. The JIT does not trace into this function, so the search
+    runs as a plain native loop instead of being unrolled into the trace.
+    """
+    size = len(thetape) // width
+    if width == 1:
+        while 0 <= pos < size and thetape[pos] != '\x00':
+            pos += stride
+        return pos
+
+    while 0 <= pos < size:
+        base = pos * width
+        zero = True
+        for i in range(width):
+            if thetape[base + i] != '\x00':
+                zero = False
+                break
+        if zero:
+            return pos
+        pos += stride
+    return pos
 
 
 class Tape(object):
     """
     Tape with _virtualizable_ hint for better JIT optimization.
     Note: We only virtualize 'position' and 'thetape', not 'thetape[*]'.
+
+    Cells are 8, 16 or 32 bits wide and wrap around. They are stored
+    little-endian in a list of chars, which RPython lays out as a flat byte
+    array, so the default 8-bit tape takes one byte per cell.
+
+    A growable tape keeps at least 'margin' cells on both sides of the head,
+    where margin is the largest offset any instruction uses. Only move() and
+    scan() then need to check for room; everything addressed relative to
+    the head is known to be inside the tape.
     """
-    _immutable_fields_ = ['size']
-    _virtualizable_ = ['position', 'thetape']
+    _immutable_fields_ = ['width', 'mask', 'growable', 'margin']
+    _virtualizable_ = ['position', 'thetape', 'size']
 
-    def __init__(self):
+    def __init__(self, size=30000, cell_bits=8, growable=False, margin=0):
         self = hint(self, access_directly=True, fresh_virtualizable=True)
-        self.size = 30000
-        self.thetape = [0] * self.size  # Standard BF tape size
+        self.size = size
+        self.width = cell_bits // 8
+        self.mask = (1 << cell_bits) - 1
+        self.growable = growable
+        if growable:
+            self.margin = margin
+        else:
+            self.margin = 0
+        self.thetape = ['\x00'] * (size * self.width)
         self.position = 0
+        if growable:
+            self.make_room()
 
-    def get(self):
+    def make_room(self):
+        """
+        Called when the head has come closer than 'margin' to either end.
+        Leaving a fixed-size tape raises TapeError; a growable one doubles
+        its size, as often as needed, towards the side it ran out on.
+        """
         pos = self.position
-        assert 0 <= pos < self.size
-        return self.thetape[pos]
+        size = self.size
+        if not self.growable:
+            if pos < 0 or pos >= size:
+                raise TapeError(pos, size)
+            return
 
-    def set(self, val):
-        pos = self.position
-        assert 0 <= pos < self.size
-        self.thetape[pos] = val
+        margin = self.margin
+        left = 0
+        new_size = size
+        while pos + left < margin:
+            left += new_size
+            new_size *= 2
+        while pos + left >= new_size - margin:
+            new_size *= 2
 
-    def inc(self):
-        pos = self.position
-        assert 0 <= pos < self.size
-        self.thetape[pos] += 1
+        width = self.width
+        right = new_size - size - left
+        self.thetape = (['\x00'] * (left * width) + self.thetape +
+                        ['\x00'] * (right * width))
+        self.size = new_size
+        self.position = pos + left
 
-    def dec(self):
-        pos = self.position
-        assert 0 <= pos < self.size
-        self.thetape[pos] -= 1
+    def load(self, pos):
+        if pos < 0 or pos >= self.size:
+            raise TapeError(pos, self.size)
+        width = self.width
+        t = self.thetape
+        if width == 1:
+            return ord(t[pos])
+        base = pos * width
+        if width == 2:
+            return ord(t[base]) | (ord(t[base + 1]) << 8)
+        return (ord(t[base]) | (ord(t[base + 1]) << 8) |
+                (ord(t[base + 2]) << 16) | (ord(t[base + 3]) << 24))
 
-    def advance(self):
-        self.position += 1
-        assert 0 <= self.position < self.size
+    def store(self, pos, value):
+        if pos < 0 or pos >= self.size:
+            raise TapeError(pos, self.size)
+        width = self.width
+        t = self.thetape
+        if width == 1:
+            t[pos] = chr(value & 0xff)
+            return
+        base = pos * width
+        t[base] = chr(value & 0xff)
+        t[base + 1] = chr((value >> 8) & 0xff)
+        if width == 4:
+            t[base + 2] = chr((value >> 16) & 0xff)
+            t[base + 3] = chr((value >> 24) & 0xff)
 
-    def devance(self):
-        self.position -= 1
-        assert 0 <= self.position < self.size
+    def get(self):
+        return self.load(self.position)
 
+    def get_at(self, offset):
+        return self.load(self.position + offset)
+
+    def set_at(self, offset, val):
+        self.store(self.position + offset, val)
+
+    def add_at(self, offset, n):
+        pos = self.position + offset
+        self.store(pos, self.load(pos) + n)
+
+    def mul_add(self, offset, target, factor):
+        value = self.load(self.position + offset)
+        # The loop this came from does not run at all when the counter is
+        # 0, and then the target may well be off the end of the tape. The
+        # code generated for --aot and --engine=python checks this as well
+        if value != 0:
+            dst = self.position + target
+            self.store(dst, self.load(dst) + value * factor)
+
+    def move(self, n):
+        pos = self.position + n
+        self.position = pos
+        if pos < self.margin or pos >= self.size - self.margin:
+            self.make_room()
+
+    def scan(self, stride):
+        pos = scan_tape(self.thetape, self.position, stride, self.width)
+        self.position = pos
+        if pos < self.margin or pos >= self.size - self.margin:
+            self.make_room()
+
+
+def tape_size_for(tape_size, grow_tape):
+    """
+    Returns the number of cells a fresh tape starts with: tape_size, or
+    the default for the kind of tape if that is 0.
+    """
+    if tape_size != 0:
+        return tape_size
+    if grow_tape:
+        return INITIAL_GROWABLE_TAPE_SIZE
+    return DEFAULT_TAPE_SIZE
+
+
+def write_all(fd, data):
+    while len(data) > 0:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class OutputBuffer(object):
+    """
+    Collects the bytes written by '.' and passes them to os.write() once
+    'size' of them have piled up, instead of making one system call per
+    byte. A size of 1 makes the output unbuffered.
+    """
+    def __init__(self, fd, size=8192):
+        self.fd = fd
+        self.size = size
+        self.chars = []
+
+    def write(self, c):
+        self.chars.append(c)
+        if len(self.chars) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if len(self.chars) > 0:
+            data = "".join(self.chars)
+            self.chars = []
+            write_all(self.fd, data)
+
+
+def make_output(fd, options):
+    """
+    Returns the OutputBuffer for writing to fd, unbuffered if the options
+    say so.
+    """
+    if options.unbuffered:
+        return OutputBuffer(fd, 1)
+    return OutputBuffer(fd, OUTPUT_BUFFER_SIZE)
+
+
+# What ',' does to the cell once stdin is exhausted
+EOF_UNCHANGED = 0
+EOF_ZERO = 1
+EOF_MINUS_ONE = 2
+
+
+class InputBuffer(object):
+    """
+    Reads stdin ahead in chunks of 'size' bytes, so that ',' only needs a
+    system call once per chunk. read() returns the next byte, or -1 at the
+    end of the input.
+    """
+    _immutable_fields_ = ['fd', 'size', 'eof_mode']
+
+    def __init__(self, fd, size=65536, eof_mode=EOF_UNCHANGED):
+        self.fd = fd
+        self.size = size
+        self.eof_mode = eof_mode
+        self.data = ""
+        self.pos = 0
+        self.at_eof = False
+
+    def read(self):
+        if self.pos >= len(self.data):
+            if self.at_eof:
+                return -1
+            self.data = os.read(self.fd, self.size)
+            self.pos = 0
+            if len(self.data) == 0:
+                self.at_eof = True
+                return -1
+        c = ord(self.data[self.pos])
+        self.pos += 1
+        return c
+
+
+class MemoryOutput(OutputBuffer):
+    """
+    Output that is kept in memory instead of being written to a file
+    descriptor; getvalue() returns everything written so far.
+    """
+    def __init__(self):
+        OutputBuffer.__init__(self, -1, 8192)
+        self.chunks = []
+
+    def flush(self):
+        if len(self.chars) > 0:
+            self.chunks.append("".join(self.chars))
+            self.chars = []
+
+    def getvalue(self):
+        self.flush()
+        return "".join(self.chunks)
+
+
+class MemoryInput(InputBuffer):
+    """
+    Input that comes from a string: the whole of it is the one chunk that
+    has been read ahead, and there is nothing more to read after it.
+    """
+    def __init__(self, data, eof_mode=EOF_UNCHANGED):
+        InputBuffer.__init__(self, -1, len(data), eof_mode)
+        self.data = data
+        self.at_eof = True
+
+
+class Instruction(object):
+    """
+    One instruction of the intermediate representation built by parse().
+    'pos' is the index in the source text of the character it came from.
+    """
+    def __init__(self, op, arg=0, offset=0, target=0, pos=0):
+        self.op = op
+        self.arg = arg
+        self.offset = offset
+        self.target = target
+        self.pos = pos
 
-def mainloop(program, bracket_map):
-    pc = 0
-    tape = Tape()
 
-    # Promote program to a constant - it never changes during execution
-    program = promote_string(program)
+class Program(object):
+    """
+    Compiled BF program: parallel arrays of opcodes, operands, offsets,
+    MUL_ADD targets and source positions. None of the arrays change after
+    assemble(), so with 'program' being green the JIT constant-folds every
+    instruction fetch. 'reach' is the largest distance from the head any
+    instruction accesses.
+    """
+    _immutable_fields_ = ['ops[*]', 'args[*]', 'offsets[*]', 'targets[*]',
+                          'positions[*]', 'length', 'reach']
+
+    def __init__(self, ops, args, offsets, targets, positions):
+        self.ops = ops
+        self.args = args
+        self.offsets = offsets
+        self.targets = targets
+        self.positions = positions
+        self.length = len(ops)
+        reach = 0
+        for i in range(self.length):
+            reach = max(reach, max(abs(offsets[i]), abs(targets[i])))
+        self.reach = reach
+
+    def run(self, input="", max_steps=0, tape_size=0, cell_bits=8,
+            grow_tape=False, eof_mode=EOF_UNCHANGED, time_limit=0.0):
+        """
+        Runs the program on a fresh tape with 'input' as its whole input,
+        and returns everything it printed. A program can be run any number
+        of times. With max_steps > 0, StepLimitExceeded is raised once the
+        program has executed more than that many instructions in loops, and
+        with time_limit > 0.0, TimeLimitExceeded once it has run for more
+        than that many seconds. TapeError, a ProgramError, is raised if the
+        head leaves a tape that cannot grow. In each case the exception's
+        'output' is what had been printed until then.
+        """
+        tape = Tape(tape_size_for(tape_size, grow_tape), cell_bits, grow_tape,
+                    self.reach)
+        output = MemoryOutput()
+        try:
+            mainloop(self, tape, output, MemoryInput(input, eof_mode), None,
+                     Limits(max_steps, time_limit))
+        except LimitExceeded, e:
+            e.output = output.getvalue()
+            raise
+        except ProgramError, e:
+            e.output = output.getvalue()
+            raise
+        return output.getvalue()
+
+
+def pad(text, width):
+    """
+    Right-aligns text in a field of the given width (RPython's % formatting
+    has no field widths).
+    """
+    if len(text) >= width:
+        return text
+    return " " * (width - len(text)) + text
+
+
+def percent(part, total):
+    if total == 0:
+        return "0.0%"
+    tenths = part * 1000 // total
+    return "%d.%d%%" % (tenths // 10, tenths % 10)
+
+
+def top_indices(values, n):
+    """
+    Returns the indices of the n largest non-zero values, largest first.
+    """
+    result = []
+    taken = [False] * len(values)
+    for _ in range(n):
+        best = -1
+        for i in range(len(values)):
+            if not taken[i] and values[i] > 0 and (
+                    best < 0 or values[i] > values[best]):
+                best = i
+        if best < 0:
+            break
+        taken[best] = True
+        result.append(best)
+    return result
+
+
+def source_location(source, pos):
+    """
+    Returns the "line:column" of index pos in the source text.
+    """
+    line = 1
+    column = 1
+    for i in range(pos):
+        if source[i] == '\n':
+            line += 1
+            column = 1
+        else:
+            column += 1
+    return "%d:%d" % (line, column)
+
 
-    while pc < len(program):
-        jitdriver.jit_merge_point(pc=pc, tape=tape, program=program,
-                bracket_map=bracket_map)
+def source_snippet(source, start, stop, width):
+    """
+    Returns up to width BF commands from source[start:stop], leaving out
+    comments.
+    """
+    chars = []
+    for i in range(start, min(stop, len(source))):
+        c = source[i]
+        if (c == '+' or c == '-' or c == '>' or c == '<' or c == '.' or
+                c == ',' or c == '[' or c == ']'):
+            if len(chars) == width:
+                chars.append("...")
+                break
+            chars.append(c)
+    return "".join(chars)
+
+
+class Profiler(object):
+    """
+    Counts how often every instruction is executed and how many iterations
+    every loop makes, and prints a report of the hottest ones to stderr.
+    """
+    def __init__(self, program, source):
+        self.program = program
+        self.source = source
+        self.counts = [0] * program.length
+        self.iterations = [0] * program.length  # indexed by the pc of '['
 
-        code = program[pc]
+    def count(self, pc):
+        self.counts[pc] += 1
 
-        if code == ">":
-            tape.advance()
+    def enter_loop(self, pc):
+        self.iterations[pc] += 1
 
-        elif code == "<":
-            tape.devance()
+    def report(self, fd, limit=20):
+        program = self.program
+        total = 0
+        for count in self.counts:
+            total += count
 
-        elif code == "+":
-            tape.inc()
+        lines = ["==== profile: %d instructions executed ====" % total,
+                 "", "by opcode:"]
+        per_opcode = [0] * len(OPCODE_NAMES)
+        for pc in range(program.length):
+            per_opcode[program.ops[pc]] += self.counts[pc]
+        for op in top_indices(per_opcode, len(OPCODE_NAMES)):
+            lines.append("  %s %s %s" % (
+                (OPCODE_NAMES[op] + " " * 16)[:16],
+                pad("%d" % per_opcode[op], 14),
+                pad(percent(per_opcode[op], total), 7)))
 
-        elif code == "-":
-            tape.dec()
+        # Instructions executed inside each loop, nested loops included
+        inside = [0] * program.length
+        for pc in range(program.length):
+            if program.ops[pc] == JUMP_IF_ZERO:
+                for i in range(pc, program.args[pc] + 1):
+                    inside[pc] += self.counts[i]
 
-        elif code == ".":
-            os.write(1, chr(tape.get()))
+        lines.append("")
+        lines.append("hot loops:  location  iterations  instructions  source")
+        for pc in top_indices(inside, limit):
+            close = program.args[pc]
+            lines.append("  %s %s %s %s  %s" % (
+                pad(source_location(self.source, program.positions[pc]), 9),
+                pad("%d" % self.iterations[pc], 11),
+                pad("%d" % inside[pc], 13),
+                pad(percent(inside[pc], total), 7),
+                source_snippet(self.source, program.positions[pc],
+                               program.positions[close] + 1, 40)))
 
-        elif code == ",":
-            tape.set(ord(os.read(0, 1)[0]))
+        lines.append("")
+        lines.append("hot instructions:  location  count")
+        for pc in top_indices(self.counts, limit):
+            lines.append("  %s %s %s  %s" % (
+                pad(source_location(self.source, program.positions[pc]), 9),
+                pad("%d" % self.counts[pc], 14),
+                pad(percent(self.counts[pc], total), 7),
+                get_location(pc, program, None)))
+        lines.append("")
+        write_all(fd, "\n".join(lines))
 
-        elif code == "[":
+
+class JitLocationStats(object):
+    """
+    What the JIT did at one green location (a pc of the program). The
+    counts are NonConstant for the reason given in JitStats.start().
+    """
+    def __init__(self, pc):
+        self.pc = pc
+        self.loops = NonConstant(0)
+        self.operations = NonConstant(0)
+        self.aborts = NonConstant(0)
+        self.too_long = NonConstant(0)
+
+
+class JitStats(object):
+    """
+    Records, per green location, how many loops were compiled and how many
+    traces were aborted, plus the number of bridges. Bridges have no green
+    location of their own: each one is compiled after a guard failed often
+    enough, so many bridges mean guards keep failing. Filled in by
+    JitStatsHooks, which do nothing until start() is called; untranslated,
+    they never fire at all.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.program = None
+        self.source = ""
+        self.locations = []
+        self.bridges = 0
+        self.bridge_operations = 0
+
+    def start(self, program, source):
+        self.enabled = True
+        self.program = program
+        self.source = source
+        # Everything the hooks change is set up here rather than by them:
+        # they are only annotated along with the JIT, after the rest of the
+        # program, when what 'locations' holds or whether a count is a
+        # constant can no longer change
+        self.locations = [JitLocationStats(pc)
+                          for pc in range(program.length)]
+        self.bridges = NonConstant(0)
+        self.bridge_operations = NonConstant(0)
+        if we_are_translated():
+            # Also count how often compiled loops and bridges are entered;
+            # the backend only adds the counters to code it logs, so this
+            # needs PYPYLOG=jit-backend:FILE as well
+            jit_hooks.stats_set_debug(None, True)
+
+    def report(self, fd, limit=20):
+        if not we_are_translated():
+            write_all(fd, "==== jit-stats: no JIT when running untranslated; "
+                          "translate with -Ojit ====\n")
+            return
+        weights = [stats.loops + stats.aborts + stats.too_long
+                   for stats in self.locations]
+        # The JIT sets up its own counters when it first traces, and reading
+        # them before that crashes; a loop compiled or a trace aborted means
+        # it has
+        traced = False
+        for weight in weights:
+            if weight > 0:
+                traced = True
+        if not traced:
+            write_all(fd, "==== jit-stats: nothing was compiled ====\n")
+            return
+
+        lines = ["==== jit-stats ====",
+                 "tracing:  %d ms" % int(1000 * jit_hooks.stats_get_times_value(
+                     None, Counters.TRACING)),
+                 "backend:  %d ms" % int(1000 * jit_hooks.stats_get_times_value(
+                     None, Counters.BACKEND)),
+                 "loops:    %d" % jit_hooks.stats_get_counter_value(
+                     None, Counters.TOTAL_COMPILED_LOOPS),
+                 "bridges:  %d (%d operations)" % (self.bridges,
+                                                   self.bridge_operations),
+                 "aborted:  %d (too long: %d)" % (
+                     jit_hooks.stats_get_counter_value(
+                         None, Counters.ABORT_TOO_LONG) +
+                     jit_hooks.stats_get_counter_value(
+                         None, Counters.ABORT_BRIDGE) +
+                     jit_hooks.stats_get_counter_value(
+                         None, Counters.ABORT_BAD_LOOP) +
+                     jit_hooks.stats_get_counter_value(
+                         None, Counters.ABORT_ESCAPE),
+                     jit_hooks.stats_get_counter_value(
+                         None, Counters.ABORT_TOO_LONG))]
+
+        loop_entries = 0
+        bridge_entries = 0
+        # An lltype array, which can be indexed but not iterated over
+        runs = jit_hooks.stats_get_loop_run_times(None)
+        for i in range(len(runs)):
+            stat = runs[i]
+            if stat.type == 'b':
+                bridge_entries += stat.counter
+            else:
+                loop_entries += stat.counter
+        if len(runs) > 0:
+            lines.append("entries:  %d into loops, %d into bridges" % (
+                loop_entries, bridge_entries))
+        else:
+            lines.append("entries:  not counted; set "
+                         "PYPYLOG=jit-backend:FILE to count them")
+
+        # Only reported after start(). get_location() is also the JIT's
+        # get_printable_location, which must never be passed a None program
+        program = self.program
+        assert program is not None
+        lines.append("")
+        lines.append("by location:  loops  operations  aborts  too long  "
+                     "location")
+        for i in top_indices(weights, limit):
+            stats = self.locations[i]
+            pos = program.positions[stats.pc]
+            lines.append("  %s %s %s %s  %s %s  %s" % (
+                pad("%d" % stats.loops, 5),
+                pad("%d" % stats.operations, 11),
+                pad("%d" % stats.aborts, 7),
+                pad("%d" % stats.too_long, 9),
+                pad(source_location(self.source, pos), 9),
+                get_location(stats.pc, program, None),
+                source_snippet(self.source, pos, len(self.source), 20)))
+        lines.append("")
+        write_all(fd, "\n".join(lines))
+
+
+jit_stats = JitStats()
+
+
+class JitStatsHooks(JitHookInterface):
+    """
+    The JIT hooks that fill in jit_stats, installed by jitpolicy(). Their
+    own instance must not be seen by the rest of the program (see
+    JitHookInterface), so everything they record goes to jit_stats.
+    """
+    def after_compile(self, debug_info):
+        if jit_stats.enabled:
+            stats = jit_stats.locations[debug_info.greenkey[0].getint()]
+            stats.loops += 1
+            stats.operations += len(debug_info.operations)
+
+    def after_compile_bridge(self, debug_info):
+        if jit_stats.enabled:
+            jit_stats.bridges += 1
+            jit_stats.bridge_operations += len(debug_info.operations)
+
+    def on_abort(self, reason, jitdriver, greenkey, greenkey_repr, logops,
+                 operations):
+        if jit_stats.enabled:
+            jit_stats.locations[greenkey[0].getint()].aborts += 1
+
+    def on_trace_too_long(self, jitdriver, greenkey, greenkey_repr):
+        if jit_stats.enabled:
+            jit_stats.locations[greenkey[0].getint()].too_long += 1
+
+
+class ProgramError(Exception):
+    """
+    Raised for a program that cannot be compiled or run to its end:
+    BracketError by the compiler, TapeError by mainloop(). 'output' is
+    filled in by callers that keep the output.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.output = ""
+
+
+class BracketError(ProgramError):
+    def __init__(self, char, pos):
+        ProgramError.__init__(self, "unmatched '%s' at character %d"
+                                    % (char, pos + 1))
+        self.pos = pos
+
+
+class TapeError(ProgramError):
+    def __init__(self, pos, size):
+        ProgramError.__init__(self, "the head left the tape: cell %d of %d"
+                                    % (pos, size))
+        self.pos = pos
+
+
+class LimitExceeded(Exception):
+    """
+    Raised by mainloop() when the program has used up its step or time
+    budget. 'output' is filled in by callers that keep the output.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.output = ""
+
+
+class StepLimitExceeded(LimitExceeded):
+    def __init__(self, steps):
+        LimitExceeded.__init__(self, "step limit exceeded after %d steps"
+                                     % steps)
+        self.steps = steps
+
+
+class TimeLimitExceeded(LimitExceeded):
+    def __init__(self, time_limit):
+        LimitExceeded.__init__(self, "time limit of %d ms exceeded"
+                                     % int(time_limit * 1000))
+        self.time_limit = time_limit
+
+
+# How many steps run between two looks at the clock when there is a time
+# limit
+TIME_CHECK_INTERVAL = 1 << 16
+
+
+class Suspended(Exception):
+    """
+    Raised by mainloop() when it has written a snapshot on SIGUSR1 and
+    stopped.
+    """
+    def __init__(self, path):
+        self.path = path
+
+
+# Signal asking a run with --snapshot to save its state and stop
+SNAPSHOT_SIGNAL = signal.SIGUSR1
+
+
+class Limits(object):
+    """
+    Step and time budget of one run, and when it takes snapshots.
+    mainloop() only calls check() when its step count passes the value the
+    previous check() returned, so the clock and signals are looked at once
+    every TIME_CHECK_INTERVAL steps, and never if there is neither a time
+    limit nor a snapshot file.
+    """
+    _immutable_fields_ = ['max_steps', 'time_limit', 'deadline',
+                          'snapshot_path', 'snapshot_every']
+
+    def __init__(self, max_steps=0, time_limit=0.0, snapshot_path=None,
+                 snapshot_every=0):
+        if max_steps <= 0:
+            max_steps = sys.maxint
+        self.max_steps = max_steps
+        self.time_limit = time_limit
+        self.deadline = 0.0
+        if time_limit > 0.0:
+            self.deadline = time.time() + time_limit
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.next_snapshot = -1
+        self.snapshot_due = False
+        self.stop_after_snapshot = False
+        if snapshot_path is not None:
+            watch_signal(SNAPSHOT_SIGNAL)
+
+    @dont_look_inside
+    def check(self, steps):
+        """
+        Raises LimitExceeded if the budget is used up, sets snapshot_due
+        if a snapshot should be taken, and returns the step count at which
+        to check again.
+        """
+        if steps > self.max_steps:
+            raise StepLimitExceeded(steps)
+        if self.deadline != 0.0 and time.time() > self.deadline:
+            raise TimeLimitExceeded(self.time_limit)
+        next_check = self.max_steps
+        if self.snapshot_path is not None:
+            if poll_signal() == SNAPSHOT_SIGNAL:
+                self.snapshot_due = True
+                self.stop_after_snapshot = True
+            if self.snapshot_every > 0:
+                if self.next_snapshot < 0:
+                    self.next_snapshot = steps + self.snapshot_every
+                elif steps >= self.next_snapshot:
+                    self.snapshot_due = True
+                    self.next_snapshot = steps + self.snapshot_every
+                next_check = min(next_check, self.next_snapshot)
+        if self.deadline != 0.0 or self.snapshot_path is not None:
+            if next_check - steps > TIME_CHECK_INTERVAL:
+                next_check = steps + TIME_CHECK_INTERVAL
+        return next_check
+
+    @dont_look_inside
+    def take_snapshot(self, program, pc, steps, tape, output, input):
+        """
+        Saves the state to snapshot_path, and raises Suspended if the
+        snapshot was asked for by SNAPSHOT_SIGNAL. If the file cannot be
+        written the run goes on.
+        """
+        self.snapshot_due = False
+        output.flush()
+        snapshot = Snapshot(program, pc, steps, tape, input.data[input.pos:],
+                            input.at_eof, input.eof_mode, "")
+        try:
+            save_snapshot(self.snapshot_path, snapshot)
+        except OSError:
+            write_all(2, "cannot write snapshot %s\n" % self.snapshot_path)
+            self.stop_after_snapshot = False
+            return
+        if self.stop_after_snapshot:
+            raise Suspended(self.snapshot_path)
+
+
+def mainloop(program, tape, output, input, profiler=None, limits=None,
+             pc=0, steps=0):
+    """
+    Runs program from pc until it ends, or until it exceeds the given
+    Limits. A step is one executed instruction, but steps are only counted
+    at loop back-edges, which charge the whole loop body at once:
+    straight-line code does no counting, and code outside loops runs at
+    most once anyway. A run resumed from a snapshot passes the saved pc
+    and step count.
+    """
+    if limits is None:
+        limits = Limits()
+    next_check = limits.check(steps)
+
+    while pc < program.length:
+        jitdriver.jit_merge_point(pc=pc, tape=tape, output=output,
+                input=input, program=program, profiler=profiler,
+                steps=steps, next_check=next_check, limits=limits)
+
+        if profiler is not None:
+            profiler.count(pc)
+
+        op = program.ops[pc]
+        arg = program.args[pc]
+        offset = program.offsets[pc]
+
+        if op == ADD:
+            tape.add_at(offset, arg)
+
+        elif op == MOVE:
+            tape.move(arg)
+
+        elif op == OUTPUT:
+            output.write(chr(tape.get_at(offset) & 0xff))
+
+        elif op == INPUT:
+            # Show everything printed so far before waiting for input
+            output.flush()
+            c = input.read()
+            if c >= 0:
+                tape.set_at(offset, c)
+            elif input.eof_mode == EOF_ZERO:
+                tape.set_at(offset, 0)
+            elif input.eof_mode == EOF_MINUS_ONE:
+                tape.set_at(offset, -1)
+
+        elif op == CLEAR:
+            tape.set_at(offset, 0)
+
+        elif op == MUL_ADD:
+            tape.mul_add(offset, program.targets[pc], arg)
+
+        elif op == SCAN:
+            tape.scan(arg)
+
+        elif op == JUMP_IF_ZERO:
             if tape.get() == 0:
-                # Use elidable function for bracket lookup
-                pc = get_bracket_target(bracket_map, pc)
+                # The operand is the pc of the matching ]
+                pc = arg
+            elif profiler is not None:
+                profiler.enter_loop(pc)
 
-        elif code == "]":
+        elif op == JUMP_IF_NONZERO:
             if tape.get() != 0:
-                # Backward jump - use elidable lookup
-                pc = get_bracket_target(bracket_map, pc)
+                steps += pc - arg
+                if steps > next_check:
+                    next_check = limits.check(steps)
+                    if limits.snapshot_due:
+                        # Continue with the loop body, as the jump would
+                        limits.take_snapshot(program, arg + 1, steps, tape,
+                                             output, input)
+                # Backward jump to the matching [
+                pc = arg
+                if profiler is not None:
+                    profiler.enter_loop(pc)
                 # Tell JIT this is a loop back-edge
-                jitdriver.can_enter_jit(pc=pc, tape=tape, program=program,
-                        bracket_map=bracket_map)
+                jitdriver.can_enter_jit(pc=pc, tape=tape, output=output,
+                        input=input, program=program, profiler=profiler,
+                        steps=steps, next_check=next_check, limits=limits)
 
         pc += 1
 
 
-@unroll_safe
+class Parser(object):
+    """
+    Turns BF source into a list of Instructions a chunk at a time, so that
+    a large program can be compiled while it is being read, without ever
+    holding the whole source text in memory.
+
+    Consecutive +/- fold into one ADD and consecutive >/< into one MOVE; a
+    run whose net effect is zero vanishes. Runs continue across chunks.
+    """
+    def __init__(self):
+        self.code = []
+        self.pos = 0        # source position of the next chunk's first char
+        self.open = []      # source positions of the unmatched '['s
+
+    @unroll_safe
+    def feed(self, chunk):
+        """
+        @unroll_safe tells the JIT it's safe to unroll loops in this
+        function, even though it contains a loop. This is safe because the
+        parser only runs before the main loop.
+        """
+        code = self.code
+        base = self.pos
+        for i in range(len(chunk)):
+            char = chunk[i]
+            pos = base + i
+            if char == '+' or char == '-' or char == '>' or char == '<':
+                if char == '+' or char == '-':
+                    op = ADD
+                else:
+                    op = MOVE
+                if char == '+' or char == '>':
+                    delta = 1
+                else:
+                    delta = -1
+
+                if len(code) > 0 and code[-1].op == op:
+                    code[-1].arg += delta
+                    if code[-1].arg == 0:
+                        code.pop()
+                else:
+                    code.append(Instruction(op, delta, pos=pos))
+
+            elif char == '.':
+                code.append(Instruction(OUTPUT, pos=pos))
+            elif char == ',':
+                code.append(Instruction(INPUT, pos=pos))
+            elif char == '[':
+                code.append(Instruction(JUMP_IF_ZERO, pos=pos))
+                self.open.append(pos)
+            elif char == ']':
+                if len(self.open) == 0:
+                    raise BracketError(']', pos)
+                self.open.pop()
+                code.append(Instruction(JUMP_IF_NONZERO, pos=pos))
+        self.pos = base + len(chunk)
+
+    def finish(self):
+        """
+        Returns the Instructions of everything fed so far. Raises
+        BracketError if a '[' is still open.
+        """
+        if len(self.open) > 0:
+            raise BracketError('[', self.open[-1])
+        return self.code
+
+
 def parse(program):
     """
-    @unroll_safe tells the JIT it's safe to unroll loops in this function,
-    even though it contains a loop. This is safe because parse() is only
-    called once before the main loop.
+    Returns the list of Instructions for the whole source text program.
+    """
+    parser = Parser()
+    parser.feed(program)
+    return parser.finish()
+
+
+def eliminate_dead_loops(code):
+    """
+    Removes the loops of parse()'s output that can never run because the
+    cell under the head is known to be 0 at their '[': at the start of the
+    program, where the whole tape is 0 (so "comment loops" at the top of a
+    program go), and right after another loop, which only ends once its
+    cell is 0. Runs that end up next to each other are folded again, so
+    the > and < around a comment loop in >[...]< cancel out.
+    """
+    result = []
+    zero = True         # the cell under the head is known to be 0
+    clean = True        # no cell has been changed yet
+    i = 0
+    while i < len(code):
+        instr = code[i]
+        op = instr.op
+        if op == JUMP_IF_ZERO and zero:
+            depth = 0
+            end = i
+            while end < len(code):
+                if code[end].op == JUMP_IF_ZERO:
+                    depth += 1
+                elif code[end].op == JUMP_IF_NONZERO:
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            if end < len(code):
+                # Skipped, and the cell is still 0 afterwards
+                i = end + 1
+                continue
+
+        if ((op == ADD or op == MOVE) and len(result) > 0 and
+                result[-1].op == op):
+            arg = result[-1].arg + instr.arg
+            if arg == 0:
+                result.pop()
+            else:
+                result[-1] = Instruction(op, arg, pos=result[-1].pos)
+        else:
+            result.append(instr)
+
+        if op == ADD or op == INPUT or op == JUMP_IF_ZERO:
+            zero = False
+            clean = False
+        elif op == MOVE:
+            zero = clean
+        elif op == JUMP_IF_NONZERO:
+            zero = True
+        i += 1
+    return result
+
+
+def match_multiply_loop(code, start, stop):
+    """
+    Checks whether the loop body code[start:stop], made up of ADD and MOVE
+    only, is a clear or multiply loop: the head ends up where it started and
+    the cell under it changes by exactly one per iteration. A loop that
+    decrements its counter runs as many times as the counter's value; since
+    cells wrap, one that increments it runs -value times. Either way it can
+    be replaced by one MUL_ADD per other touched cell followed by a CLEAR.
+    Returns the replacement instructions, or None if the loop does not
+    qualify.
+    """
+    offsets = []
+    factors = []
+    position = 0
+    for i in range(start, stop):
+        instr = code[i]
+        if instr.op == MOVE:
+            position += instr.arg
+        else:
+            found = False
+            for k in range(len(offsets)):
+                if offsets[k] == position:
+                    factors[k] += instr.arg
+                    found = True
+                    break
+            if not found:
+                offsets.append(position)
+                factors.append(instr.arg)
+
+    if position != 0:
+        return None
+
+    counter_step = 0
+    for k in range(len(offsets)):
+        if offsets[k] == 0:
+            counter_step = factors[k]
+    if counter_step != -1 and counter_step != 1:
+        return None
+
+    pos = code[start - 1].pos
+    replacement = []
+    for k in range(len(offsets)):
+        if offsets[k] != 0 and factors[k] != 0:
+            replacement.append(Instruction(MUL_ADD, -counter_step * factors[k],
+                                           0, offsets[k], pos))
+    replacement.append(Instruction(CLEAR, pos=pos))
+    return replacement
+
+
+def optimize_loops(code):
+    """
+    Replaces every innermost loop that consists of a single MOVE with a SCAN,
+    and every one that match_multiply_loop() recognizes with its
+    straight-line equivalent.
+    """
+    result = []
+    for instr in code:
+        result.append(instr)
+        if instr.op != JUMP_IF_NONZERO:
+            continue
+
+        # Walk back over the loop body; it qualifies only if it contains
+        # nothing but ADD and MOVE up to the opening bracket.
+        start = len(result) - 2
+        while start >= 0 and (result[start].op == ADD or
+                              result[start].op == MOVE):
+            start -= 1
+        if start < 0 or result[start].op != JUMP_IF_ZERO:
+            continue
+
+        if start + 2 == len(result) - 1 and result[start + 1].op == MOVE:
+            replacement = [Instruction(SCAN, result[start + 1].arg,
+                                       pos=result[start].pos)]
+        else:
+            replacement = match_multiply_loop(result, start + 1,
+                                              len(result) - 1)
+        if replacement is not None:
+            del result[start:]
+            result.extend(replacement)
+
+    return result
+
+
+def optimize_offsets(code):
+    """
+    Removes the MOVEs from straight-line code. Between two brackets the head
+    is only tracked at compile time: every instruction gets the offset of
+    the cell it works on relative to where the head was at the last bracket,
+    and one MOVE with the net amount is emitted just before the next bracket
+    or SCAN.
     """
-    parsed = []
-    bracket_map = {}
+    result = []
+    shift = 0
+    shift_pos = 0
+    for instr in code:
+        if instr.op == MOVE:
+            if shift == 0:
+                shift_pos = instr.pos
+            shift += instr.arg
+        elif (instr.op == JUMP_IF_ZERO or instr.op == JUMP_IF_NONZERO or
+              instr.op == SCAN):
+            if shift != 0:
+                result.append(Instruction(MOVE, shift, pos=shift_pos))
+                shift = 0
+            result.append(instr)
+        else:
+            result.append(Instruction(instr.op, instr.arg,
+                                      instr.offset + shift,
+                                      instr.target + shift, instr.pos))
+    if shift != 0:
+        result.append(Instruction(MOVE, shift, pos=shift_pos))
+    return result
+
+
+def optimize_peephole(code):
+    """
+    Works on the output of optimize_offsets(), where straight-line code
+    addresses cells relative to a fixed head. Within such code, ADDs to the
+    same cell are merged as long as nothing reads the cell in between, and
+    an ADD whose result a CLEAR of the cell overwrites is dropped.
+    """
+    result = []
+    pending = {}    # offset -> index in result of an ADD not read since
+    for instr in code:
+        op = instr.op
+        if op == ADD:
+            j = pending.get(instr.offset, -1)
+            if j >= 0:
+                prev = result[j]
+                result[j] = Instruction(ADD, prev.arg + instr.arg,
+                                        prev.offset, 0, prev.pos)
+                continue
+            pending[instr.offset] = len(result)
+        elif op == CLEAR:
+            j = pending.get(instr.offset, -1)
+            if j >= 0:
+                prev = result[j]
+                result[j] = Instruction(ADD, 0, prev.offset, 0, prev.pos)
+                del pending[instr.offset]
+        elif op == OUTPUT or op == INPUT:
+            if instr.offset in pending:
+                del pending[instr.offset]
+        elif op == MUL_ADD:
+            if instr.offset in pending:
+                del pending[instr.offset]
+            if instr.target in pending:
+                del pending[instr.target]
+        else:
+            # Brackets, SCAN and MOVE move the head or branch
+            pending = {}
+        result.append(instr)
+    return [instr for instr in result if instr.op != ADD or instr.arg != 0]
+
+
+def optimize(code):
+    """
+    Runs the optimization passes over the output of parse().
+    """
+    code = eliminate_dead_loops(code)
+    code = optimize_loops(code)
+    code = optimize_offsets(code)
+    code = optimize_peephole(code)
+    return code
+
+
+def optimizer_report(source):
+    """
+    Returns how many instructions each optimization pass leaves of source.
+    """
+    code = parse(source)
+    lines = ["==== optimizer ====",
+             "parsed:           %d instructions" % len(code)]
+    before = len(code)
+    code = eliminate_dead_loops(code)
+    lines.append("dead loops:       %d removed" % (before - len(code)))
+    before = len(code)
+    code = optimize_loops(code)
+    lines.append("loop idioms:      %d removed" % (before - len(code)))
+    before = len(code)
+    code = optimize_offsets(code)
+    lines.append("offsets:          %d removed" % (before - len(code)))
+    before = len(code)
+    code = optimize_peephole(code)
+    lines.append("peephole:         %d removed" % (before - len(code)))
+    lines.append("result:           %d instructions" % len(code))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def assemble(code):
+    """
+    Lays the Instructions out as flat arrays and matches up the brackets:
+    the operand of each bracket becomes the pc of its partner. Raises
+    BracketError if they do not match.
+    """
+    # Allocated at their final size, like in deserialize(): the JIT only
+    # treats the arrays as constant ('ops[*]' etc.) if they never resize
+    length = len(code)
+    ops = [0] * length
+    args = [0] * length
+    offsets = [0] * length
+    targets = [0] * length
+    positions = [0] * length
     leftstack = []
 
+    for pc in range(length):
+        instr = code[pc]
+        ops[pc] = instr.op
+        args[pc] = instr.arg
+        offsets[pc] = instr.offset
+        targets[pc] = instr.target
+        positions[pc] = instr.pos
+
+        if instr.op == JUMP_IF_ZERO:
+            leftstack.append(pc)
+        elif instr.op == JUMP_IF_NONZERO:
+            if len(leftstack) == 0:
+                raise BracketError(']', instr.pos)
+            left = leftstack.pop()
+            args[left] = pc
+            args[pc] = left
+    if len(leftstack) > 0:
+        raise BracketError('[', positions[leftstack[-1]])
+
+    return Program(ops, args, offsets, targets, positions)
+
+
+# Bump this whenever parse(), optimize() or the opcodes change, so that
+# programs cached by an older interpreter are compiled afresh.
+OPTIMIZER_VERSION = 2
+CACHE_MAGIC = "BFC1"
+
+
+def write_int32(chars, value):
+    value &= 0xffffffff
+    chars.append(chr(value & 0xff))
+    chars.append(chr((value >> 8) & 0xff))
+    chars.append(chr((value >> 16) & 0xff))
+    chars.append(chr((value >> 24) & 0xff))
+
+
+def read_int32(data, i):
+    value = (ord(data[i]) | (ord(data[i + 1]) << 8) |
+             (ord(data[i + 2]) << 16) | (ord(data[i + 3]) << 24))
+    if value >= 0x80000000:
+        value -= 0x100000000
+    return value
+
+
+def serialize(program):
+    """
+    Encodes a Program as: magic, optimizer version, instruction count, then
+    for every instruction its opcode (1 byte) followed by operand, offset,
+    target and source position (4 bytes each, little-endian).
+    """
+    chars = [CACHE_MAGIC]
+    write_int32(chars, OPTIMIZER_VERSION)
+    write_int32(chars, program.length)
+    for pc in range(program.length):
+        chars.append(chr(program.ops[pc]))
+        write_int32(chars, program.args[pc])
+        write_int32(chars, program.offsets[pc])
+        write_int32(chars, program.targets[pc])
+        write_int32(chars, program.positions[pc])
+    return "".join(chars)
+
+
+def deserialize(data):
+    """
+    Decodes what serialize() wrote. Returns None if data is not a complete
+    program written by this optimizer version.
+    """
+    header = len(CACHE_MAGIC) + 8
+    if len(data) < header or data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        return None
+    if read_int32(data, len(CACHE_MAGIC)) != OPTIMIZER_VERSION:
+        return None
+    length = read_int32(data, len(CACHE_MAGIC) + 4)
+    if length < 0 or len(data) != header + length * 17:
+        return None
+
+    ops = [0] * length
+    args = [0] * length
+    offsets = [0] * length
+    targets = [0] * length
+    positions = [0] * length
+    i = header
+    for pc in range(length):
+        ops[pc] = ord(data[i])
+        args[pc] = read_int32(data, i + 1)
+        offsets[pc] = read_int32(data, i + 5)
+        targets[pc] = read_int32(data, i + 9)
+        positions[pc] = read_int32(data, i + 13)
+        i += 17
+    return Program(ops, args, offsets, targets, positions)
+
+
+def read_all(fd):
+    """
+    Returns everything left in fd. A regular file is read with a single
+    read of its size; pipes and short reads fall back to collecting chunks
+    and joining them once at the end, which keeps loading linear in the
+    size of the input.
+    """
+    size = os.fstat(fd).st_size
+    data = ""
+    if size > 0:
+        data = os.read(fd, size)
+        if len(data) == size:
+            return data
+    chunks = [data]
+    while True:
+        chunk = os.read(fd, LOAD_CHUNK_SIZE)
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+def read_file(path):
+    """
+    Returns the whole contents of the file, or None if it cannot be read.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY, 0777)
+    except OSError:
+        return None
+    try:
+        return read_all(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(path, data):
+    """
+    Writes data under a temporary name first and then renames it to path,
+    so that a concurrent reader never sees a half-written file.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        write_all(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
+
+
+def write_to_cache(path, data):
+    """
+    Writes data to path in a cache directory. Returns False if that failed;
+    the cache is only an optimization, so callers go on without it.
+    """
+    try:
+        write_file_atomically(path, data)
+    except OSError:
+        return False
+    return True
+
+
+def getenv(name, default):
+    """
+    Returns the environment variable name, or default if it is not set;
+    RPython's os.environ.get() takes no default.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value
+
+
+def owned_privately(path):
+    """
+    Returns True if path exists, belongs to the current user and nobody
+    else can write to it. Anything else in a cache could have been put
+    there by another user, and must not be trusted.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    # os.getuid() is unsigned once translated
+    return st.st_uid == intmask(os.getuid()) and st.st_mode & 022 == 0
+
+
+def private_dir(path):
+    """
+    Creates the directory path, accessible only to the current user, if it
+    does not exist yet. Returns False if it cannot be used as a cache: it
+    could not be created, or it is not owned_privately().
+    """
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass    # already exists
+    return owned_privately(path)
+
+
+def cache_dir_for(options, name):
+    """
+    Returns the cache directory for name: --cache-dir, or by default name
+    in $XDG_CACHE_HOME (~/.cache if that is not set). Returns None if it is
+    not a private_dir(), or there is no home directory to put it in.
+    """
+    if options.cache_dir is not None:
+        cache_dir = options.cache_dir
+    else:
+        base = getenv("XDG_CACHE_HOME", "")
+        if not base:
+            home = getenv("HOME", "")
+            if not home:
+                return None
+            base = home + "/.cache"
+        try:
+            os.mkdir(base, 0700)
+        except OSError:
+            pass    # already exists
+        cache_dir = base + "/" + name
+    if not private_dir(cache_dir):
+        return None
+    return cache_dir
+
+
+def compile_program(source, cache_dir=None):
+    """
+    Parses, optimizes and assembles source, and raises BracketError, a
+    ProgramError, if its brackets do not match. With a cache_dir, the
+    result is looked up under a hash of the optimizer version and the
+    source first, and stored there after compiling; a cache_dir that is not
+    a private_dir() is not used.
+    """
+    if cache_dir is None or not private_dir(cache_dir):
+        return assemble(optimize(parse(source)))
+
+    key = md5("%d:%s" % (OPTIMIZER_VERSION, source)).hexdigest()
+    path = cache_dir + "/" + key + ".bfc"
+    data = None
+    if owned_privately(path):
+        data = read_file(path)
+    if data is not None:
+        program = deserialize(data)
+        if program is not None:
+            return program
+
+    program = assemble(optimize(parse(source)))
+    write_to_cache(path, serialize(program))
+    return program
+
+
+SNAPSHOT_MAGIC = "BFS2"
+
+
+class Snapshot(object):
+    """
+    Machine state of a stopped run: the program, the pc to continue at, the
+    step count, the tape, the input that had been read ahead but not
+    consumed yet, and the output not written yet. A run stopped at a loop
+    back-edge flushes its output first, so only the state computed by
+    precompute_state() has output pending.
+    """
+    def __init__(self, program, pc, steps, tape, input_data, at_eof,
+                 eof_mode, output):
+        self.program = program
+        self.pc = pc
+        self.steps = steps
+        self.tape = tape
+        self.input_data = input_data
+        self.at_eof = at_eof
+        self.eof_mode = eof_mode
+        self.output = output
+
+
+def encode_snapshot(snapshot):
+    """
+    Returns snapshot as a string of: magic, pc, step count (8 bytes), cell
+    bits, growable flag, tape size, head position, EOF mode and flag, then
+    the pending input, the serialized program, the raw tape and the
+    pending output, each preceded by its length. Integers are
+    little-endian.
+    """
+    tape = snapshot.tape
+    chars = [SNAPSHOT_MAGIC]
+    write_int32(chars, snapshot.pc)
+    write_int32(chars, snapshot.steps)
+    write_int32(chars, snapshot.steps >> 32)
+    write_int32(chars, tape.width * 8)
+    write_int32(chars, int(tape.growable))
+    write_int32(chars, tape.size)
+    write_int32(chars, tape.position)
+    write_int32(chars, snapshot.eof_mode)
+    write_int32(chars, int(snapshot.at_eof))
+    for data in [snapshot.input_data, serialize(snapshot.program),
+                 "".join(tape.thetape), snapshot.output]:
+        write_int32(chars, len(data))
+        chars.append(data)
+    return "".join(chars)
+
+
+def save_snapshot(path, snapshot):
+    write_file_atomically(path, encode_snapshot(snapshot))
+
+
+def load_snapshot(data):
+    """
+    Decodes what encode_snapshot() returned. Returns None if data is not a
+    complete snapshot written by this version.
+    """
+    i = len(SNAPSHOT_MAGIC)
+    if len(data) < i + 40 or data[:i] != SNAPSHOT_MAGIC:
+        return None
+    pc = read_int32(data, i)
+    steps = (read_int32(data, i + 4) & 0xffffffff) | (
+        read_int32(data, i + 8) << 32)
+    cell_bits = read_int32(data, i + 12)
+    growable = read_int32(data, i + 16) != 0
+    size = read_int32(data, i + 20)
+    position = read_int32(data, i + 24)
+    eof_mode = read_int32(data, i + 28)
+    at_eof = read_int32(data, i + 32) != 0
+    i += 36
+
+    parts = []
+    for k in range(4):
+        if i + 4 > len(data):
+            return None
+        length = read_int32(data, i)
+        i += 4
+        if length < 0 or i + length > len(data):
+            return None
+        parts.append(data[i:i + length])
+        i += length
+    if i != len(data):
+        return None
+
+    program = deserialize(parts[1])
+    if (program is None or pc < 0 or pc > program.length or
+            (cell_bits != 8 and cell_bits != 16 and cell_bits != 32) or
+            size <= 0 or len(parts[2]) != size * (cell_bits // 8) or
+            position < 0 or position >= size):
+        return None
+    tape = Tape(1, cell_bits, growable, program.reach)
+    tape.thetape = [c for c in parts[2]]
+    tape.size = size
+    tape.position = position
+    return Snapshot(program, pc, steps, tape, parts[0], at_eof, eof_mode,
+                    parts[3])
+
+
+def precompute(program, tape, output, budget, limits):
+    """
+    Runs program from the start on tape, and stops before its first ','
+    or after budget instructions, whichever comes first. Returns the pc it
+    stopped at and the number of instructions it executed; what it printed
+    is in output. Up to that point the run depends on nothing but the
+    program, so this is evaluation at compile time, done by a plain loop
+    that the JIT does not see. Every instruction counts towards limits.
+    """
+    pc = 0
+    steps = 0
+    next_check = limits.check(steps)
+    while pc < program.length and steps < budget:
+        op = program.ops[pc]
+        arg = program.args[pc]
+        offset = program.offsets[pc]
+        if op == INPUT:
+            break
+        elif op == ADD:
+            tape.add_at(offset, arg)
+        elif op == MOVE:
+            tape.move(arg)
+        elif op == OUTPUT:
+            output.write(chr(tape.get_at(offset) & 0xff))
+        elif op == CLEAR:
+            tape.set_at(offset, 0)
+        elif op == MUL_ADD:
+            tape.mul_add(offset, program.targets[pc], arg)
+        elif op == SCAN:
+            tape.scan(arg)
+        elif op == JUMP_IF_ZERO:
+            if tape.get() == 0:
+                pc = arg
+        elif op == JUMP_IF_NONZERO:
+            if tape.get() != 0:
+                pc = arg
+        pc += 1
+        steps += 1
+        if steps > next_check:
+            next_check = limits.check(steps)
+    return pc, steps
+
+
+def precompute_state(program, options, tape, limits, output):
+    """
+    Returns the Snapshot that precompute() leaves program in, starting
+    from the fresh tape, and writes what it printed to output. The
+    snapshot is kept in the cache directory (see cache_dir_for()), keyed
+    by a hash of the compiled program, the tape options and the budget,
+    and loaded instead of computed the next time; without a private cache
+    directory it is computed every time.
+    """
+    cache_dir = cache_dir_for(options, "bf-pre")
+    path = None
+    if cache_dir is not None:
+        key = md5("%d:%d:%d:%d:%s" % (
+            tape.size, tape.width, int(tape.growable), options.precompute,
+            serialize(program))).hexdigest()
+        path = cache_dir + "/" + key + ".bfs"
+        data = None
+        # Its output is printed as is, so it has to be one this user saved
+        if owned_privately(path):
+            data = read_file(path)
+        if data is not None:
+            snapshot = load_snapshot(data)
+            # Past the step limit, a run has to stop partway through
+            # instead
+            if snapshot is not None and snapshot.steps <= limits.max_steps:
+                output.flush()
+                write_all(output.fd, snapshot.output)
+                return snapshot
+
+    printed = MemoryOutput()
+    try:
+        pc, steps = precompute(program, tape, printed, options.precompute,
+                               limits)
+    finally:
+        # Also when a limit stopped it, as mainloop() would have printed
+        # this much
+        output.flush()
+        write_all(output.fd, printed.getvalue())
+    snapshot = Snapshot(program, pc, steps, tape, "", False, options.eof_mode,
+                        printed.getvalue())
+    if path is not None:
+        write_to_cache(path, encode_snapshot(snapshot))
+    return snapshot
+
+
+def c_cell_type(cell_bits):
+    if cell_bits == 8:
+        return "unsigned char"
+    elif cell_bits == 16:
+        return "unsigned short"
+    return "unsigned int"
+
+
+def emit_c(program, tape_size, cell_bits, eof_mode, unbuffered=False):
+    """
+    Translates a compiled program into a C program that does the same with
+    a fixed tape of tape_size cells, reading stdin and writing stdout
+    (unbuffered if asked to). The brackets become while loops, and the
+    arithmetic is done on unsigned values, so that cells wrap around like
+    Tape's.
+
+    Like Tape, the program stops with an error when the head, or a cell
+    addressed relative to it, leaves the tape. The checks are left out
+    where the moves since the last check show that the cell is on the
+    tape, and the array has program.reach cells of padding on both sides.
+    The error path is marked cold, which keeps the checks cheap in loops.
+    """
+    reach = program.reach
+    lines = ["#include <stdio.h>",
+             "#include <stdlib.h>",
+             "",
+             "typedef %s cell;" % c_cell_type(cell_bits),
+             "static cell tape[%d];" % (reach + tape_size + reach),
+             "#define START (tape + %d)" % reach,
+             "#define END (tape + %d)" % (reach + tape_size),
+             "",
+             "#ifdef __GNUC__",
+             "#define COLD __attribute__((noreturn, cold))",
+             "#else",
+             "#define COLD",
+             "#endif",
+             "",
+             "static COLD void off_tape(long pos)",
+             "{",
+             "    fflush(stdout);",
+             "    fprintf(stderr, \"the head left the tape: \"",
+             "            \"cell %%ld of %d\\n\", pos);" % tape_size,
+             "    exit(%d);" % PROGRAM_ERROR_EXIT_STATUS,
+             "}",
+             "",
+             "int main(void)",
+             "{",
+             "    cell *p = START;",
+             "    int c;",
+             "    (void)c;"]
+    if unbuffered:
+        lines.append("    setvbuf(stdout, NULL, _IONBF, 0);")
+    depth = 1
+    # At least this many cells are known to be on the tape left and right
+    # of the head
+    low = 0
+    high = tape_size - 1
+    for pc in range(program.length):
+        op = program.ops[pc]
+        arg = program.args[pc]
+        offset = program.offsets[pc]
+        indent = "    " * depth
+        if (op == ADD or op == OUTPUT or op == INPUT or op == CLEAR or
+                op == MUL_ADD):
+            if offset < -low:
+                lines.append(c_tape_check(indent, offset))
+                low = -offset
+            elif offset > high:
+                lines.append(c_tape_check(indent, offset))
+                high = offset
+
+        if op == ADD:
+            lines.append("%sp[%d] += (unsigned)%d;" % (indent, offset, arg))
+        elif op == MOVE:
+            if arg < -low or arg > high:
+                lines.append(c_tape_check(indent, arg))
+            lines.append("%sp += %d;" % (indent, arg))
+            low = max(low + arg, 0)
+            high = max(high - arg, 0)
+        elif op == OUTPUT:
+            lines.append("%sputchar((unsigned char)p[%d]);" % (indent, offset))
+        elif op == INPUT:
+            lines.append("%sfflush(stdout);" % indent)
+            lines.append("%sc = getchar();" % indent)
+            if eof_mode == EOF_UNCHANGED:
+                lines.append("%sif (c != EOF) p[%d] = (cell)c;"
+                             % (indent, offset))
+            elif eof_mode == EOF_ZERO:
+                lines.append("%sp[%d] = c != EOF ? (cell)c : 0;"
+                             % (indent, offset))
+            else:
+                lines.append("%sp[%d] = (cell)c;" % (indent, offset))
+        elif op == CLEAR:
+            lines.append("%sp[%d] = 0;" % (indent, offset))
+        elif op == MUL_ADD:
+            target = program.targets[pc]
+            update = "p[%d] += (unsigned)p[%d] * (unsigned)%d;" % (
+                target, offset, arg)
+            if target < -low or target > high:
+                lines.append("%sif (p[%d]) {" % (indent, offset))
+                lines.append(c_tape_check(indent + "    ", target))
+                lines.append("%s    %s" % (indent, update))
+                lines.append("%s}" % indent)
+            else:
+                lines.append("%sif (p[%d]) %s" % (indent, offset, update))
+        elif op == SCAN:
+            lines.append("%swhile (*p) {" % indent)
+            lines.append(c_tape_check(indent + "    ", arg))
+            lines.append("%s    p += %d;" % (indent, arg))
+            lines.append("%s}" % indent)
+            if arg < 0:
+                low = 0
+            else:
+                high = 0
+        elif op == JUMP_IF_ZERO:
+            lines.append("%swhile (*p) {" % indent)
+            depth += 1
+            low = 0
+            high = 0
+        elif op == JUMP_IF_NONZERO:
+            depth -= 1
+            lines.append("%s}" % ("    " * depth))
+            low = 0
+            high = 0
+    lines.append("    return 0;")
+    lines.append("}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def c_tape_check(indent, offset):
+    """
+    Returns a line of C that stops the program if the cell at offset from
+    the head is not on the tape.
+    """
+    if offset < 0:
+        return "%sif (p - START < %d) off_tape(p - START - %d);" % (
+            indent, -offset, -offset)
+    return "%sif (END - p <= %d) off_tape(p - START + %d);" % (
+        indent, offset, offset)
+
+
+def shell_quote(text):
+    # RPython's str.replace() only replaces single characters
+    return "'" + "'\\''".join(text.split("'")) + "'"
+
+
+def build_native(program, options):
+    """
+    Returns the path of an executable for program built with the system C
+    compiler ($CC, or cc), or None if it could not be built. Executables
+    are kept in the cache directory under a hash of their C source, so each
+    one is only compiled once; there has to be a private one, as they are
+    run from there.
+    """
+    source = emit_c(program, tape_size_for(options.tape_size, False),
+                    options.cell_bits, options.eof_mode, options.unbuffered)
+    compiler = getenv("CC", "cc")
+
+    cache_dir = cache_dir_for(options, "bf-aot")
+    if cache_dir is None:
+        write_all(2, "no private cache directory for executables "
+                     "(see --cache-dir)\n")
+        return None
+    key = md5("%s\n%s" % (compiler, source)).hexdigest()
+    binary = cache_dir + "/" + key
+    # Only run an executable this user built; otherwise build it again,
+    # and the rename below replaces it
+    if owned_privately(binary):
+        return binary
+
+    if not write_to_cache(binary + ".c", source):
+        write_all(2, "cannot write %s.c\n" % binary)
+        return None
+    # Compile to a temporary name and rename, like write_file_atomically()
+    tmp = "%s.%d.tmp" % (binary, os.getpid())
+    status = os.system("%s -O2 -o %s %s" % (compiler, shell_quote(tmp),
+                                             shell_quote(binary + ".c")))
+    if status != 0:
+        write_all(2, "%s failed to compile %s.c\n" % (compiler, binary))
+        return None
+    try:
+        os.rename(tmp, binary)
+    except OSError:
+        return None
+    return binary
+
+
+# Loops nested deeper than this inside one generated Python function are
+# moved out into a function of their own; CPython refuses to compile more
+# than 20 nested blocks
+PYTHON_MAX_DEPTH = 15
+
+
+def emit_python(program, cell_bits, eof_mode):
+    """
+    Translates a compiled program into Python source defining
+    bf(t, output, input), which runs it on the list of ints t with the
+    given OutputBuffer and InputBuffer. The brackets become while loops,
+    so CPython runs the program as bytecode instead of going through
+    mainloop()'s dispatch for every instruction.
+
+    Groups of instructions are done in bulk by CPython's list operations:
+    CLEARs of adjacent cells become one slice assignment, the MUL_ADDs of
+    one multiply loop load and test their counter once, and [>] scans
+    with list.index().
+
+    A negative index would silently wrap around to the far end of the
+    list, so the code checks that the head stays on the tape where it
+    cannot tell that it does, and raises TapeError like Tape.
+    """
+    mask = (1 << cell_bits) - 1
+    functions = []
+    # One entry per function being generated: its lines, and how many of
+    # its loops are open
+    stack = [(["def bf(p, t, output, input):",
+               "    write = output.write",
+               "    read = input.read"], [0])]
+    count = 0
+    # The head is known to be at least here, so cells down to offset -low
+    # need no check
+    low = 0
     pc = 0
-    for char in program:
-        if char in ('[', ']', '<', '>', '+', '-', ',', '.'):
-            parsed.append(char)
+    while pc < program.length:
+        op = program.ops[pc]
+        arg = program.args[pc]
+        offset = program.offsets[pc]
+        lines, depth = stack[-1]
+        indent = "    " * (depth[0] + 1)
+        cell = "t[p]"
+        if offset != 0:
+            cell = "t[p + %d]" % offset
+        # Number of instructions after this one that it handles as well
+        run = 0
+        if op == CLEAR:
+            while (pc + run + 1 < program.length and
+                   program.ops[pc + run + 1] == CLEAR and
+                   program.offsets[pc + run + 1] == offset + run + 1):
+                run += 1
+        elif op == MUL_ADD:
+            while (pc + run + 1 < program.length and
+                   program.ops[pc + run + 1] == MUL_ADD and
+                   program.offsets[pc + run + 1] == offset):
+                run += 1
 
-            if char == '[':
-                leftstack.append(pc)
-            elif char == ']':
-                left = leftstack.pop()
-                right = pc
-                bracket_map[left] = right
-                bracket_map[right] = left
-            pc += 1
+        if (op == ADD or op == OUTPUT or op == INPUT or op == CLEAR or
+                op == MUL_ADD) and offset < -low:
+            lines.append("%sif p < %d: raise TapeError(p - %d, len(t))" % (
+                indent, -offset, -offset))
+            low = -offset
 
-    return "".join(parsed), bracket_map
+        if op == CLEAR and run > 0:
+            # A slice past the end would make the list longer
+            lines.append("%sif p + %d > len(t): "
+                         "raise TapeError(len(t), len(t))"
+                         % (indent, offset + run + 1))
+            lines.append("%st[p + %d:p + %d] = [0] * %d" % (
+                indent, offset, offset + run + 1, run + 1))
+        elif op == MUL_ADD and run > 0:
+            lines.append("%sv = %s" % (indent, cell))
+            lines.append("%sif v:" % indent)
+            lowest = 0
+            for i in range(pc, pc + run + 1):
+                lowest = min(lowest, program.targets[i])
+            if lowest < -low:
+                lines.append("%s    if p < %d: raise TapeError(p - %d, len(t))"
+                             % (indent, -lowest, -lowest))
+            for i in range(pc, pc + run + 1):
+                target = "t[p + %d]" % program.targets[i]
+                lines.append("%s    %s = (%s + v * %d) & %d" % (
+                    indent, target, target, program.args[i], mask))
+        elif op == SCAN and arg == 1:
+            lines.append("%sp = t.index(0, p)" % indent)
+        elif op == ADD:
+            lines.append("%s%s = (%s + %d) & %d" % (indent, cell, cell, arg,
+                                                    mask))
+        elif op == MOVE:
+            lines.append("%sp += %d" % (indent, arg))
+            if low + arg < 0:
+                lines.append("%sif p < 0: raise TapeError(p, len(t))" % indent)
+            low = max(low + arg, 0)
+        elif op == OUTPUT:
+            lines.append("%swrite(chr(%s & 255))" % (indent, cell))
+        elif op == INPUT:
+            lines.append("%soutput.flush()" % indent)
+            lines.append("%sc = read()" % indent)
+            lines.append("%sif c >= 0: %s = c" % (indent, cell))
+            if eof_mode == EOF_ZERO:
+                lines.append("%selse: %s = 0" % (indent, cell))
+            elif eof_mode == EOF_MINUS_ONE:
+                lines.append("%selse: %s = %d" % (indent, cell, mask))
+        elif op == CLEAR:
+            lines.append("%s%s = 0" % (indent, cell))
+        elif op == MUL_ADD:
+            target = "t[p + %d]" % program.targets[pc]
+            if program.targets[pc] < -low:
+                lines.append("%sif %s:" % (indent, cell))
+                lines.append("%s    if p < %d: raise TapeError(p - %d, len(t))"
+                             % (indent, -program.targets[pc],
+                                -program.targets[pc]))
+                lines.append("%s    %s = (%s + %s * %d) & %d" % (
+                    indent, target, target, cell, arg, mask))
+            else:
+                lines.append("%sif %s: %s = (%s + %s * %d) & %d" % (
+                    indent, cell, target, target, cell, arg, mask))
+        elif op == SCAN:
+            lines.append("%swhile t[p]: p += %d" % (indent, arg))
+            if arg < 0:
+                lines.append("%sif p < 0: raise TapeError(p, len(t))" % indent)
+                low = 0
+        elif op == JUMP_IF_ZERO:
+            if depth[0] >= PYTHON_MAX_DEPTH:
+                count += 1
+                lines.append("%sp = loop%d(p, t, output, input)"
+                             % (indent, count))
+                lines = ["def loop%d(p, t, output, input):" % count,
+                         "    write = output.write",
+                         "    read = input.read"]
+                depth = [0]
+                stack.append((lines, depth))
+                indent = "    "
+            lines.append("%swhile t[p]:" % indent)
+            depth[0] += 1
+            low = 0
+        elif op == JUMP_IF_NONZERO:
+            if lines[-1].endswith(":"):
+                # The loop body has been optimized away, or was empty
+                lines.append("%spass" % indent)
+            depth[0] -= 1
+            low = 0
+            if depth[0] == 0 and len(stack) > 1:
+                lines.append("    return p")
+                functions.append("\n".join(lines))
+                stack.pop()
+        pc += run + 1
+    lines, depth = stack[0]
+    lines.append("    return p")
+    functions.append("\n".join(lines))
+    return "\n\n".join(functions) + "\n"
 
 
-def run(fp):
-    program_contents = ""
+def run_python(program, options, input_fd, output_fd):
+    """
+    Runs program with the code emit_python() generates for it. Only
+    available untranslated: RPython has no exec.
+    """
+    namespace = {"TapeError": TapeError}
+    exec emit_python(program, options.cell_bits, options.eof_mode) in namespace
+    tape_size = tape_size_for(options.tape_size, False)
+    output = make_output(output_fd, options)
+    input = InputBuffer(input_fd, INPUT_BUFFER_SIZE, options.eof_mode)
+    try:
+        try:
+            namespace["bf"](0, [0] * tape_size, output, input)
+        except (IndexError, ValueError):
+            # The head went past the right end: an index out of range, or
+            # a [>] scan that list.index() found no 0 for
+            raise TapeError(tape_size, tape_size)
+    finally:
+        output.flush()
+
+
+def compile_stream(fd):
+    """
+    Compiles the program read from fd chunk by chunk, without building the
+    source text.
+    """
+    parser = Parser()
     while True:
-        read = os.read(fp, 4096)
-        if len(read) == 0:
+        chunk = os.read(fd, LOAD_CHUNK_SIZE)
+        if len(chunk) == 0:
             break
-        program_contents += read
+        parser.feed(chunk)
+    return assemble(optimize(parser.finish()))
+
+
+def load_program(fd, options):
+    """
+    Returns the compiled program read from fd, and its source text if the
+    options need it (or "" if not).
+    """
+    # The profiler, --jit-stats and the cache need the source text itself;
+    # otherwise the program is compiled as it is read
+    if options.profile or options.jit_stats or options.cache_dir is not None:
+        source = read_all(fd)
+        return compile_program(source, options.cache_dir), source
+    return compile_stream(fd), ""
+
+
+def execute(program, source, options, input_fd, output_fd):
+    """
+    Runs program on a fresh tape, reading from input_fd and writing to
+    output_fd.
+    """
+    if options.engine == ENGINE_PYTHON and not we_are_translated():
+        run_python(program, options, input_fd, output_fd)
+        return
+    profiler = None
+    if options.profile:
+        profiler = Profiler(program, source)
+    tape = Tape(tape_size_for(options.tape_size, options.grow_tape),
+                options.cell_bits, options.grow_tape, program.reach)
+    output = make_output(output_fd, options)
+    input = InputBuffer(input_fd, INPUT_BUFFER_SIZE, options.eof_mode)
+    limits = Limits(options.max_steps, options.time_limit, options.snapshot,
+                    options.snapshot_every)
+    try:
+        pc = 0
+        steps = 0
+        if options.precompute > 0:
+            snapshot = precompute_state(program, options, tape, limits, output)
+            tape = snapshot.tape
+            pc = snapshot.pc
+            steps = snapshot.steps
+        mainloop(program, tape, output, input, profiler, limits, pc, steps)
+    finally:
+        output.flush()
+        if profiler is not None:
+            profiler.report(2)
+
+
+def resume(snapshot, options):
+    """
+    Continues the run saved in snapshot, with its remaining input coming
+    from stdin and its further output going to stdout.
+    """
+    output = make_output(1, options)
+    input = InputBuffer(0, INPUT_BUFFER_SIZE, snapshot.eof_mode)
+    input.data = snapshot.input_data
+    input.at_eof = snapshot.at_eof
+    write_all(1, snapshot.output)
+    try:
+        mainloop(snapshot.program, snapshot.tape, output, input, None,
+                 Limits(options.max_steps, options.time_limit,
+                        options.snapshot, options.snapshot_every),
+                 snapshot.pc, snapshot.steps)
+    finally:
+        output.flush()
+
+
+def run(fp, options):
+    program, source = load_program(fp, options)
     os.close(fp)
-    program, bm = parse(program_contents)
-    mainloop(program, bm)
+    if options.jit_stats:
+        jit_stats.start(program, source)
+    try:
+        execute(program, source, options, 0, 1)
+    finally:
+        if options.jit_stats:
+            jit_stats.report(2)
+
+
+class BatchJob(object):
+    """
+    One line of a batch manifest: the program to run, where its input
+    comes from and where its output goes ("-" for stdin and stdout).
+    """
+    def __init__(self, line, program, input, output):
+        self.line = line
+        self.program = program
+        self.input = input
+        self.output = output
+
+
+def parse_manifest(text):
+    """
+    Returns the BatchJobs listed in a manifest, one job per line with three
+    fields separated by blanks. Empty lines and lines starting with # are
+    skipped. Returns None if a line does not have three fields.
+    """
+    jobs = []
+    lines = text.split("\n")
+    for i in range(len(lines)):
+        line = lines[i].replace("\t", " ").replace("\r", " ")
+        fields = [field for field in line.split(" ") if field != ""]
+        if len(fields) == 0 or fields[0].startswith("#"):
+            continue
+        if len(fields) != 3:
+            return None
+        jobs.append(BatchJob(i + 1, fields[0], fields[1], fields[2]))
+    return jobs
+
+
+def run_batch(options):
+    """
+    Runs every job of the manifest given with --batch in this process, and
+    returns the number of jobs that failed. Each program file is compiled
+    once and the same Program object is reused by all the jobs that run it,
+    so the JIT's traces for it, which are keyed by the program, carry over
+    from one job to the next.
+    """
+    text = read_file(options.batch)
+    if text is None:
+        write_all(2, "cannot read batch manifest %s\n" % options.batch)
+        return 1
+    jobs = parse_manifest(text)
+    if jobs is None:
+        write_all(2, "invalid batch manifest %s: expected 'program input "
+                     "output' on each line\n" % options.batch)
+        return 1
+
+    programs = {}
+    sources = {}
+    failed = 0
+    for job in jobs:
+        input_fd = -1
+        output_fd = -1
+        try:
+            try:
+                program = programs.get(job.program, None)
+                if program is None:
+                    fd = os.open(job.program, os.O_RDONLY, 0777)
+                    try:
+                        program, source = load_program(fd, options)
+                    finally:
+                        os.close(fd)
+                    programs[job.program] = program
+                    sources[job.program] = source
+                if job.input == "-":
+                    input_fd = 0
+                else:
+                    input_fd = os.open(job.input, os.O_RDONLY, 0777)
+                if job.output == "-":
+                    output_fd = 1
+                else:
+                    output_fd = os.open(job.output, os.O_WRONLY | os.O_CREAT |
+                                        os.O_TRUNC, 0666)
+                execute(program, sources[job.program], options, input_fd,
+                        output_fd)
+            except LimitExceeded, e:
+                write_all(2, "%s:%d: %s < %s: %s\n" % (
+                    options.batch, job.line, job.program, job.input,
+                    e.message))
+                failed += 1
+            except ProgramError, e:
+                write_all(2, "%s:%d: %s < %s: %s\n" % (
+                    options.batch, job.line, job.program, job.input,
+                    e.message))
+                failed += 1
+            except OSError:
+                write_all(2, "%s:%d: cannot run %s < %s > %s\n" % (
+                    options.batch, job.line, job.program, job.input,
+                    job.output))
+                failed += 1
+        finally:
+            if input_fd > 0:
+                os.close(input_fd)
+            if output_fd > 1:
+                os.close(output_fd)
+    return failed
+
+
+DEFAULT_TAPE_SIZE = 30000
+INITIAL_GROWABLE_TAPE_SIZE = 1024
+OUTPUT_BUFFER_SIZE = 8192
+INPUT_BUFFER_SIZE = 65536
+LOAD_CHUNK_SIZE = 65536
+DEFAULT_PRECOMPUTE_STEPS = 10000000
+# How --engine runs the compiled program
+ENGINE_INTERP = 0       # mainloop(), JIT-compiled when translated
+ENGINE_PYTHON = 1       # generated Python code, untranslated only
+
+# Exit status when the program has unmatched brackets or leaves the tape
+PROGRAM_ERROR_EXIT_STATUS = 2
+# Exit status when --max-steps or --time-limit stops the program
+LIMIT_EXIT_STATUS = 3
+# Exit status when the program has been suspended into a snapshot
+SUSPENDED_EXIT_STATUS = 4
+
+
+class Options(object):
+    """
+    Command line settings of the interpreter.
+    """
+    def __init__(self):
+        self.filename = None
+        self.tape_size = 0          # 0: the default for the tape kind
+        self.cell_bits = 8
+        self.grow_tape = False
+        self.unbuffered = False
+        self.eof_mode = EOF_UNCHANGED
+        self.profile = False
+        self.jit_stats = False
+        self.jit_params = []
+        self.cache_dir = None
+        self.batch = None
+        self.max_steps = 0          # 0: no limit
+        self.time_limit = 0.0       # seconds, 0.0: no limit
+        self.snapshot = None
+        self.snapshot_every = 0
+        self.resume = None
+        self.aot = False
+        self.engine = ENGINE_INTERP
+        self.optimizer_stats = False
+        self.precompute = 0         # instruction budget, 0: off
+
+
+USAGE = """usage: %s [options] program.b
+       %s [options] --batch=MANIFEST
+       %s [options] --resume=SNAPSHOT
+  --tape-size=N     number of tape cells (default 30000, or 1024 initially
+                    with --grow-tape)
+  --cell-bits=N     cell width: 8, 16 or 32 (default 8); cells wrap around
+  --grow-tape       let the tape grow in both directions as needed
+  --unbuffered      write every '.' out immediately
+  --eof=MODE        what ',' stores at end of input: unchanged (default),
+                    0 or -1
+  --profile         print instruction counts and the hottest loops to stderr
+                    at exit
+  --optimizer-stats print how many instructions each optimization pass
+                    removed to stderr before running
+  --jit-stats       print what the JIT compiled, aborted and how long it took
+                    to stderr at exit; entries into compiled loops are only
+                    counted with PYPYLOG=jit-backend:FILE
+  --jit=PARAMS      tune the JIT before the program starts: "off", or
+                    comma-separated key=value pairs such as
+                    threshold=200,trace_limit=20000 (threshold,
+                    function_threshold, trace_eagerness, trace_limit,
+                    loop_longevity, ... as in PyPy's --jit)
+  --cache-dir=DIR   keep compiled programs in DIR and reuse them when the
+                    same source is run again; DIR must belong to you and
+                    be writable by nobody else
+  --max-steps=N     stop the program after about N executed instructions
+  --time-limit=SEC  stop the program after SEC seconds of running
+                    (a program stopped by either limit exits with status 3)
+  --snapshot=FILE   on SIGUSR1, save the state of the run to FILE and stop
+                    with exit status 4
+  --snapshot-every=N
+                    also save the state to FILE about every N steps and
+                    keep running
+  --resume=FILE     continue the run saved in FILE; tape options come from
+                    the snapshot, and --profile and --jit-stats are not
+                    available
+  --aot             compile the program to C, build it with $CC (default cc)
+                    and run the executable; executables are kept in
+                    --cache-dir (default $XDG_CACHE_HOME/bf-aot, or
+                    ~/.cache/bf-aot), which must belong to you and be
+                    writable by nobody else. Only the tape options, --eof
+                    and --unbuffered apply; the tape cannot grow
+  --engine=NAME     how to run the program: interp (default), or python to
+                    turn it into Python code run by exec, which is much
+                    faster untranslated; only the tape options, --eof and
+                    --unbuffered apply to it
+  --precompute[=N]  run the program up to its first ',' (for at most N
+                    instructions, default 10000000) once, keep the
+                    resulting tape and output in --cache-dir (default
+                    $XDG_CACHE_HOME/bf-pre, or ~/.cache/bf-pre), and start
+                    later runs from them; these instructions count towards
+                    --max-steps
+  --batch=MANIFEST  run many jobs in one process; each line of MANIFEST is
+                    "program input output" ("-" for stdin/stdout), and each
+                    program is compiled once and keeps its JIT traces
+"""
+
+
+def parse_args(argv):
+    """
+    Returns the Options given by argv, or None if argv is not valid.
+    """
+    options = Options()
+    for i in range(1, len(argv)):
+        arg = argv[i]
+        if not arg.startswith("--"):
+            options.filename = arg
+            continue
+
+        eq = arg.find("=")
+        if eq < 0:
+            name = arg
+            value = ""
+        else:
+            name = arg[:eq]
+            value = arg[eq + 1:]
+
+        try:
+            if name == "--tape-size":
+                options.tape_size = int(value)
+                if options.tape_size <= 0:
+                    return None
+            elif name == "--grow-tape":
+                options.grow_tape = True
+            elif name == "--unbuffered":
+                options.unbuffered = True
+            elif name == "--profile":
+                options.profile = True
+            elif name == "--jit-stats":
+                options.jit_stats = True
+            elif name == "--optimizer-stats":
+                options.optimizer_stats = True
+            elif name == "--jit":
+                options.jit_params.append(value)
+            elif name == "--cache-dir":
+                if value == "":
+                    return None
+                options.cache_dir = value
+            elif name == "--max-steps":
+                options.max_steps = int(value)
+                if options.max_steps <= 0:
+                    return None
+            elif name == "--time-limit":
+                options.time_limit = float(value)
+                if options.time_limit <= 0.0:
+                    return None
+            elif name == "--snapshot":
+                if value == "":
+                    return None
+                options.snapshot = value
+            elif name == "--snapshot-every":
+                options.snapshot_every = int(value)
+                if options.snapshot_every <= 0:
+                    return None
+            elif name == "--resume":
+                if value == "":
+                    return None
+                options.resume = value
+            elif name == "--precompute":
+                if value == "":
+                    options.precompute = DEFAULT_PRECOMPUTE_STEPS
+                else:
+                    options.precompute = int(value)
+                    if options.precompute <= 0:
+                        return None
+            elif name == "--engine":
+                if value == "interp":
+                    options.engine = ENGINE_INTERP
+                elif value == "python":
+                    options.engine = ENGINE_PYTHON
+                else:
+                    return None
+            elif name == "--aot":
+                options.aot = True
+            elif name == "--batch":
+                if value == "":
+                    return None
+                options.batch = value
+            elif name == "--eof":
+                if value == "unchanged":
+                    options.eof_mode = EOF_UNCHANGED
+                elif value == "0":
+                    options.eof_mode = EOF_ZERO
+                elif value == "-1":
+                    options.eof_mode = EOF_MINUS_ONE
+                else:
+                    return None
+            elif name == "--cell-bits":
+                options.cell_bits = int(value)
+                if (options.cell_bits != 8 and options.cell_bits != 16 and
+                        options.cell_bits != 32):
+                    return None
+            else:
+                return None
+        except ValueError:
+            return None
+
+    if options.snapshot_every > 0 and options.snapshot is None:
+        return None
+    if options.engine != ENGINE_INTERP:
+        # The generated code has none of the interpreter's machinery
+        if (options.aot or options.resume is not None or
+                options.precompute > 0 or options.grow_tape or
+                options.profile or options.jit_stats or
+                options.max_steps > 0 or options.time_limit > 0.0 or
+                options.snapshot is not None):
+            return None
+    if options.aot:
+        # The executable has none of the interpreter's machinery
+        if (options.filename is None or options.grow_tape or
+                options.profile or options.jit_stats or
+                options.max_steps > 0 or options.time_limit > 0.0 or
+                options.snapshot is not None or options.precompute > 0):
+            return None
+    if options.batch is not None:
+        # The --jit-stats report describes the locations of one program,
+        # and a snapshot the state of one run
+        if (options.filename is not None or options.resume is not None or
+                options.jit_stats or options.snapshot is not None):
+            return None
+    elif options.resume is not None:
+        # The profiler and --jit-stats need the source text
+        if (options.filename is not None or options.profile or
+                options.jit_stats or options.precompute > 0):
+            return None
+    elif options.filename is None:
+        return None
+    return options
 
 
 def entry_point(argv):
-    try:
-        filename = argv[1]
-    except IndexError:
-        print "You must supply a filename"
+    options = parse_args(argv)
+    if options is None:
+        print USAGE % (argv[0], argv[0], argv[0])
         return 1
 
-    run(os.open(filename, os.O_RDONLY, 0777))
+    if options.engine == ENGINE_PYTHON and we_are_translated():
+        print "--engine=python only works when running untranslated"
+        return 1
+
+    for params in options.jit_params:
+        try:
+            set_user_param(jitdriver, params)
+        except ValueError:
+            print "invalid --jit parameters: %s" % params
+            return 1
+
+    if options.batch is not None:
+        if run_batch(options) > 0:
+            return 1
+        return 0
+
+    try:
+        if options.optimizer_stats and options.filename is not None:
+            source = read_file(options.filename)
+            if source is not None:
+                write_all(2, optimizer_report(source))
+
+        if options.resume is not None:
+            data = read_file(options.resume)
+            snapshot = None
+            if data is not None:
+                snapshot = load_snapshot(data)
+            if snapshot is None:
+                write_all(2, "%s is not a snapshot of this interpreter "
+                             "version\n" % options.resume)
+                return 1
+            resume(snapshot, options)
+        elif options.aot:
+            fd = os.open(options.filename, os.O_RDONLY, 0777)
+            try:
+                program, source = load_program(fd, options)
+            finally:
+                os.close(fd)
+            binary = build_native(program, options)
+            if binary is None:
+                return 1
+            os.execv(binary, [binary])
+        else:
+            run(os.open(options.filename, os.O_RDONLY, 0777), options)
+    except ProgramError, e:
+        write_all(2, "%s\n" % e.message)
+        return PROGRAM_ERROR_EXIT_STATUS
+    except LimitExceeded, e:
+        write_all(2, "%s\n" % e.message)
+        return LIMIT_EXIT_STATUS
+    except Suspended, e:
+        write_all(2, "suspended; continue with --resume=%s\n" % e.path)
+        return SUSPENDED_EXIT_STATUS
     return 0
 
 
@@ -214,8 +2664,8 @@ def target(*args):
 
 def jitpolicy(driver):
     from rpython.jit.codewriter.policy import JitPolicy
-    return JitPolicy()
+    return JitPolicy(JitStatsHooks())
 
 
 if __name__ == "__main__":
-    entry_point(sys.argv)
+    sys.exit(entry_point(sys.argv))
@@ -0,0 +1,160 @@
+"""
+BF ジョブの並列実行
+
+マニフェストに並べた (プログラム, 入力, 出力) のジョブを、指定した数のワーカーで
+同時に実行する。各ジョブはインタプリタ (既定では ./example6-c) の別プロセスと
+して動くので、コア数に応じてスループットが伸びる。
+
+- マニフェストの形式は example6.py の --batch と同じで、1 行に
+  "プログラム 入力 出力" を空白区切りで書く (# で始まる行と空行は無視)
+- 入力・出力の "-" は --batch と同じくこのスクリプトの標準入力・標準出力を表す。
+  標準入力は 1 つしかないので、入力が "-" のジョブは 1 つまでとする
+- 結果は終わった順ではなくマニフェストの順に、終わり次第出力する
+- ジョブごとの所要時間・終了コードと、全体の所要時間を標準エラー出力に表示する
+- 失敗したジョブが 1 つでもあれば終了コードは 1
+
+使い方:
+    python3 parallel.py -j 8 jobs.txt
+    python3 parallel.py --interp "python2 example6.py --eof=0" jobs.txt
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job(object):
+    def __init__(self, line, program, input, output):
+        self.line = line
+        self.program = program
+        self.input = input
+        self.output = output
+
+
+class Result(object):
+    def __init__(self, job, status, elapsed, stdout=b"", error=""):
+        self.job = job
+        self.status = status
+        self.elapsed = elapsed
+        self.stdout = stdout
+        self.error = error
+
+
+def default_interpreter():
+    if os.path.exists("./example6-c"):
+        return ["./example6-c"]
+    return ["python2", "example6.py"]
+
+
+def read_manifest(path):
+    jobs = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) != 3:
+                raise ValueError("%s:%d: expected 'program input output'"
+                                 % (path, number))
+            jobs.append(Job(number, *fields))
+    return jobs
+
+
+def run_job(command, job, timeout):
+    """
+    ジョブを 1 つ実行して Result を返す。ワーカーのスレッドは子プロセスを
+    待つだけなので、GIL があっても子プロセスは並列に動く。
+    """
+    stdin = None    # "-": the job inherits our stdin
+    stdout = subprocess.PIPE
+    start = time.perf_counter()
+    try:
+        if job.input != "-":
+            stdin = open(job.input, "rb")
+        if job.output != "-":
+            stdout = open(job.output, "wb")
+        proc = subprocess.run(command + [job.program], stdin=stdin,
+                              stdout=stdout, stderr=subprocess.PIPE,
+                              timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return Result(job, None, time.perf_counter() - start,
+                      error="timed out after %gs" % timeout)
+    except OSError as e:
+        return Result(job, None, time.perf_counter() - start, error=str(e))
+    finally:
+        for f in (stdin, stdout):
+            if hasattr(f, "close"):
+                f.close()
+    elapsed = time.perf_counter() - start
+
+    error = proc.stderr.decode("utf-8", "replace").strip()
+    if proc.returncode != 0 and not error:
+        error = "exited with status %d" % proc.returncode
+    return Result(job, proc.returncode, elapsed, proc.stdout or b"", error)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("manifest")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of jobs run at once (default: CPU count)")
+    parser.add_argument("--interp", type=shlex.split,
+                        default=default_interpreter(), metavar="COMMAND",
+                        help="interpreter command, options included; "
+                             "default: ./example6-c if it exists, else "
+                             "'python2 example6.py'")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds before a single job is killed")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="only report failed jobs")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    readers = [job for job in jobs if job.input == "-"]
+    if len(readers) > 1:
+        parser.error("%s:%d: only one job can read stdin ('-' as input), "
+                     "line %d already does" % (args.manifest, readers[1].line,
+                                              readers[0].line))
+
+    failed = 0
+    busy = 0.0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        # map() yields the results in the order of the jobs, each one as soon
+        # as it and every job before it have finished
+        results = pool.map(lambda job: run_job(args.interp, job, args.timeout),
+                           jobs)
+        for r in results:
+            busy += r.elapsed
+            ok = r.status == 0
+            if not ok:
+                failed += 1
+            if r.stdout:
+                sys.stdout.buffer.write(r.stdout)
+                sys.stdout.buffer.flush()
+            if not ok or not args.quiet:
+                status = "-" if r.status is None else r.status
+                print("%s:%d: %s < %s > %s  status %s  %.3fs%s"
+                      % (args.manifest, r.job.line, r.job.program, r.job.input,
+                         r.job.output, status, r.elapsed,
+                         "  " + r.error if not ok and r.error else ""),
+                      file=sys.stderr)
+    wall = time.perf_counter() - start
+
+    print("%d jobs, %d failed, %d workers: %.3fs wall, %.3fs in jobs "
+          "(%.2fx)" % (len(jobs), failed, args.jobs, wall, busy,
+                       busy / wall if wall > 0 else 0.0), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())